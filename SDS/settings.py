@@ -136,6 +136,18 @@ USE_TZ = True
 
 STATIC_URL = "static/"
 
+# Uploaded documents are compressed at rest when that makes them smaller
+# https://docs.djangoproject.com/en/4.2/ref/settings/#storages
+
+STORAGES = {
+    "default": {
+        "BACKEND": "document_store.storage.CompressedFileSystemStorage",
+    },
+    "staticfiles": {
+        "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage",
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -0,0 +1,228 @@
+import hashlib
+from functools import reduce
+from operator import or_
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models import BooleanField, ExpressionWrapper, Max, Q, Sum
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .aggregates import folder_moved, parse_tree_path
+from .cache_manager import (
+    CacheKeys,
+    bump_generation,
+    expire_shaped_cache,
+    get_generation,
+)
+from .models import Document, Folder, FolderPermission
+
+# Access control is inherited down the folder tree: an entry on a folder
+# applies to all of its sub folders and documents. Folders without entries
+# on themselves or any parent are open to every authenticated user.
+
+
+def minimal_prefixes(tree_paths):
+    """Drop tree paths that lie below another path of the set."""
+    prefixes = []
+    for tree_path in sorted(set(tree_paths)):
+        if not prefixes or not tree_path.startswith(prefixes[-1]):
+            prefixes.append(tree_path)
+    return prefixes
+
+
+def grants_cache_key(user):
+    generation = get_generation(CacheKeys.FOLDER_GRANTS_GENERATION_KEY)
+    return f"{CacheKeys.FOLDER_GRANTS_KEY_PREFIX}{generation}_{user.pk}"
+
+
+def resolve_grants(user):
+    """
+    Return the tree paths of the folders ``user`` was given read and write
+    access to, directly or through a group. Write implies read. ``hidden``
+    lists the tree paths below which the user cannot see everything.
+    """
+    cache_key = grants_cache_key(user)
+    grants = cache.get(cache_key)
+    if grants is not None:
+        return grants
+
+    read, write, entry_paths = [], [], []
+    entries = FolderPermission.objects.annotate(
+        granted=ExpressionWrapper(
+            Q(user=user) | Q(group__in=user.groups.all()),
+            output_field=BooleanField(),
+        )
+    ).values_list("folder__tree_path", "access", "granted")
+    for tree_path, access, granted in entries:
+        entry_paths.append(tree_path)
+        if not granted:
+            continue
+        read.append(tree_path)
+        if access == FolderPermission.WRITE:
+            write.append(tree_path)
+
+    read = minimal_prefixes(read)
+    grants = {
+        "read": read,
+        "write": minimal_prefixes(write),
+        "hidden": [
+            tree_path
+            for tree_path in minimal_prefixes(entry_paths)
+            if not any(tree_path.startswith(path) for path in read)
+        ],
+    }
+    cache.set(cache_key, grants)
+    return grants
+
+
+def visible_folders(user, prefix=""):
+    """
+    Q object matching the folders ``user`` can read, ``prefix`` points at
+    the folder from another model, e.g. ``"folder__"``.
+    """
+    if user.is_superuser:
+        return Q()
+    grants = resolve_grants(user)
+    return reduce(
+        or_,
+        (Q(**{f"{prefix}tree_path__startswith": path}) for path in grants["read"]),
+        Q(**{f"{prefix}restricted": False}),
+    )
+
+
+def visible_subtree_aggregates(user, folders):
+    """
+    Subtree aggregates of those ``folders`` with folders below them that
+    ``user`` cannot see, summed over the visible folders only, so that they
+    don't give away the size or activity of hidden ones. Returns
+    ``{folder id: {field: value}}`` and needs at most one query.
+    """
+    if user.is_superuser:
+        return {}
+    hidden = resolve_grants(user)["hidden"]
+    affected = {
+        folder.pk: folder.tree_path
+        for folder in folders
+        if any(path.startswith(folder.tree_path) for path in hidden)
+    }
+    if not affected:
+        return {}
+
+    aggregates = {}
+    for pk, tree_path in affected.items():
+        subtree = Q(tree_path__startswith=tree_path)
+        aggregates[f"count_{pk}"] = Sum("document_count", filter=subtree)
+        aggregates[f"size_{pk}"] = Sum("total_size", filter=subtree)
+        aggregates[f"modified_{pk}"] = Max("last_modified", filter=subtree)
+    totals = (
+        Folder.objects.filter(visible_folders(user))
+        .filter(
+            reduce(or_, (Q(tree_path__startswith=path) for path in affected.values()))
+        )
+        .aggregate(**aggregates)
+    )
+    return {
+        pk: {
+            "subtree_document_count": totals[f"count_{pk}"] or 0,
+            "subtree_size": totals[f"size_{pk}"] or 0,
+            "subtree_last_modified": totals[f"modified_{pk}"],
+        }
+        for pk in affected
+    }
+
+
+def can_write(user, folder):
+    if user.is_superuser or not folder.restricted:
+        return True
+    return any(
+        folder.tree_path.startswith(path) for path in resolve_grants(user)["write"]
+    )
+
+
+def access_scope(user):
+    """
+    Name users that see the same folders alike, so that cached responses
+    can be shared between them.
+    """
+    if user.is_superuser:
+        return "all"
+    read = resolve_grants(user)["read"]
+    if not read:
+        return ""
+    return hashlib.sha1(",".join(read).encode()).hexdigest()
+
+
+def refresh_restrictions(tree_path):
+    """Recompute ``Folder.restricted`` for the subtree at ``tree_path``."""
+    subtree = Folder.objects.filter(tree_path__startswith=tree_path)
+    ancestor_ids = parse_tree_path(tree_path)
+    if FolderPermission.objects.filter(folder_id__in=ancestor_ids).exists():
+        subtree.update(restricted=True)
+        return
+
+    subtree.update(restricted=False)
+    acl_paths = FolderPermission.objects.filter(
+        folder__tree_path__startswith=tree_path
+    ).values_list("folder__tree_path", flat=True)
+    for acl_path in minimal_prefixes(acl_paths):
+        Folder.objects.filter(tree_path__startswith=acl_path).update(restricted=True)
+
+
+def expire_access_cache(tree_path):
+    """Drop everything cached for the subtree whose visibility changed."""
+    bump_generation(CacheKeys.FOLDER_GRANTS_GENERATION_KEY)
+    expire_shaped_cache()
+
+    folder_ids = Folder.objects.filter(tree_path__startswith=tree_path).values_list(
+        "id", flat=True
+    )
+    document_ids = Document.objects.filter(
+        folder__tree_path__startswith=tree_path
+    ).values_list("id", flat=True)
+    cache.delete_many(
+        [CacheKeys.FOLDER_LIST_KEY, CacheKeys.DOCUMENT_LIST_KEY]
+        + [f"{CacheKeys.FOLDER_DETAIL_KEY_PREFIX}{pk}" for pk in folder_ids]
+        + [f"{CacheKeys.DOCUMENT_DETAIL_KEY_PREFIX}{pk}" for pk in document_ids]
+    )
+
+
+@receiver([post_save, post_delete], sender=FolderPermission)
+def update_restrictions(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    tree_path = (
+        Folder.objects.filter(pk=instance.folder_id)
+        .values_list("tree_path", flat=True)
+        .first()
+    )
+    if tree_path is None:
+        # the folder itself is being deleted
+        bump_generation(CacheKeys.FOLDER_GRANTS_GENERATION_KEY)
+        return
+    refresh_restrictions(tree_path)
+    expire_access_cache(tree_path)
+
+
+@receiver(post_save, sender=Folder)
+def inherit_restriction(sender, instance, created, raw=False, **kwargs):
+    if raw or not created or instance.parent_id is None:
+        return
+    instance.restricted = Folder.objects.filter(
+        pk=instance.parent_id, restricted=True
+    ).exists()
+    if instance.restricted:
+        Folder.objects.filter(pk=instance.pk).update(restricted=True)
+
+
+@receiver(folder_moved)
+def update_moved_restrictions(sender, folder, old_tree_path, **kwargs):
+    refresh_restrictions(folder.tree_path)
+    expire_access_cache(folder.tree_path)
+
+
+@receiver(m2m_changed, sender=get_user_model().groups.through)
+def expire_group_grants(sender, **kwargs):
+    if kwargs["action"] in ("post_add", "post_remove", "post_clear"):
+        bump_generation(CacheKeys.FOLDER_GRANTS_GENERATION_KEY)
+        expire_shaped_cache()
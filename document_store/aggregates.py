@@ -0,0 +1,289 @@
+from collections import defaultdict
+from functools import reduce
+from operator import or_
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F, Max, Q, QuerySet, Sum, Value
+from django.db.models.functions import Concat, Substr
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import Signal, receiver
+from django.utils import timezone
+
+from .cache_manager import CacheKeys, expire_shaped_cache
+from .models import Document, Folder
+
+# sent with ``folder`` and ``old_tree_path`` after a folder got a new parent
+folder_moved = Signal()
+
+
+def parse_tree_path(tree_path):
+    return [int(pk) for pk in tree_path.split("/") if pk]
+
+
+def build_tree_path(parent_path, pk):
+    return f"{parent_path}{pk}/"
+
+
+def parent_tree_path(folder):
+    if folder.parent_id is None:
+        return ""
+    return (
+        Folder.objects.filter(pk=folder.parent_id)
+        .values_list("tree_path", flat=True)
+        .first()
+        or ""
+    )
+
+
+def invalidate_folder_cache(folder_ids):
+    keys = [f"{CacheKeys.FOLDER_DETAIL_KEY_PREFIX}{pk}" for pk in folder_ids]
+    cache.delete_many(keys + [CacheKeys.FOLDER_LIST_KEY])
+    expire_shaped_cache()
+
+
+def apply_document_delta(folder_id, count, size):
+    """
+    Add ``count`` documents and ``size`` bytes to a folder and to the
+    subtree totals of the folder and every one of its ancestors.
+    """
+    tree_path = (
+        Folder.objects.filter(pk=folder_id).values_list("tree_path", flat=True).first()
+    )
+    if tree_path is None:
+        return
+
+    now = timezone.now()
+    ancestor_ids = parse_tree_path(tree_path) or [folder_id]
+    with transaction.atomic():
+        Folder.objects.filter(pk=folder_id).update(
+            document_count=F("document_count") + count,
+            total_size=F("total_size") + size,
+            last_modified=now,
+        )
+        Folder.objects.filter(pk__in=ancestor_ids).update(
+            subtree_document_count=F("subtree_document_count") + count,
+            subtree_size=F("subtree_size") + size,
+            subtree_last_modified=now,
+        )
+    invalidate_folder_cache(ancestor_ids)
+
+
+def move_folder(folder, old_tree_path):
+    """
+    Re-root the tree paths below ``folder`` and shift its subtree totals
+    from the old ancestors to the new ones.
+    """
+    new_tree_path = build_tree_path(parent_tree_path(folder), folder.pk)
+    if new_tree_path == old_tree_path:
+        return
+
+    totals = Folder.objects.filter(pk=folder.pk).values(
+        "subtree_document_count", "subtree_size"
+    )[0]
+    old_ancestor_ids = parse_tree_path(old_tree_path)[:-1]
+    new_ancestor_ids = parse_tree_path(new_tree_path)[:-1]
+    now = timezone.now()
+
+    with transaction.atomic():
+        Folder.objects.filter(tree_path__startswith=old_tree_path).update(
+            tree_path=Concat(
+                Value(new_tree_path), Substr("tree_path", len(old_tree_path) + 1)
+            )
+        )
+        Folder.objects.filter(pk__in=old_ancestor_ids).update(
+            subtree_document_count=F("subtree_document_count")
+            - totals["subtree_document_count"],
+            subtree_size=F("subtree_size") - totals["subtree_size"],
+            subtree_last_modified=now,
+        )
+        Folder.objects.filter(pk__in=new_ancestor_ids).update(
+            subtree_document_count=F("subtree_document_count")
+            + totals["subtree_document_count"],
+            subtree_size=F("subtree_size") + totals["subtree_size"],
+            subtree_last_modified=now,
+        )
+    folder.tree_path = new_tree_path
+    invalidate_folder_cache(old_ancestor_ids + new_ancestor_ids + [folder.pk])
+    folder_moved.send(sender=Folder, folder=folder, old_tree_path=old_tree_path)
+
+
+def rebuild_folder_aggregates(folder_model=Folder, document_model=Document):
+    """
+    Recompute tree paths and all folder aggregates from scratch.
+
+    Returns the number of folders whose stored values had drifted.
+    """
+    folders = {folder.pk: folder for folder in folder_model.objects.all()}
+
+    tree_paths = {}
+
+    def resolve(pk):
+        # iterative so that deep trees don't hit the recursion limit
+        chain = []
+        while pk is not None and pk not in tree_paths:
+            chain.append(pk)
+            pk = folders[pk].parent_id
+        parent_path = tree_paths.get(pk, "")
+        for pk in reversed(chain):
+            parent_path = tree_paths[pk] = build_tree_path(parent_path, pk)
+        return parent_path
+
+    direct = {
+        row["folder"]: row
+        for row in document_model.objects.values("folder").annotate(
+            count=Count("pk"), size=Sum("size"), modified=Max("modified_at")
+        )
+    }
+    subtree = defaultdict(lambda: {"count": 0, "size": 0, "modified": None})
+    for folder_id, row in direct.items():
+        for ancestor_id in parse_tree_path(resolve(folder_id)):
+            totals = subtree[ancestor_id]
+            totals["count"] += row["count"]
+            totals["size"] += row["size"] or 0
+            if totals["modified"] is None or (
+                row["modified"] is not None and row["modified"] > totals["modified"]
+            ):
+                totals["modified"] = row["modified"]
+
+    def latest(stored, computed):
+        if stored is None or (computed is not None and computed > stored):
+            return computed
+        return stored
+
+    fields = list(Folder.AGGREGATE_FIELDS)
+    changed = []
+    for pk, folder in folders.items():
+        own = direct.get(pk, {"count": 0, "size": 0, "modified": None})
+        totals = subtree[pk]
+        expected = {
+            "tree_path": resolve(pk),
+            "document_count": own["count"],
+            "total_size": own["size"] or 0,
+            "last_modified": latest(folder.last_modified, own["modified"]),
+            "subtree_document_count": totals["count"],
+            "subtree_size": totals["size"],
+            "subtree_last_modified": latest(
+                folder.subtree_last_modified, totals["modified"]
+            ),
+        }
+        if any(getattr(folder, field) != expected[field] for field in fields):
+            for field in fields:
+                setattr(folder, field, expected[field])
+            changed.append(folder)
+
+    folder_model.objects.bulk_update(changed, fields, batch_size=500)
+    return len(changed)
+
+
+@receiver(pre_save, sender=Folder)
+def remember_folder_parent(sender, instance, raw=False, **kwargs):
+    if raw or instance.pk is None:
+        return
+    instance._previous_tree_path = (
+        Folder.objects.filter(pk=instance.pk)
+        .values_list("tree_path", flat=True)
+        .first()
+    )
+
+
+@receiver(post_save, sender=Folder)
+def update_folder_tree(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+
+    previous = getattr(instance, "_previous_tree_path", None)
+    if created or not previous:
+        instance.tree_path = build_tree_path(parent_tree_path(instance), instance.pk)
+        Folder.objects.filter(pk=instance.pk).update(tree_path=instance.tree_path)
+    else:
+        move_folder(instance, previous)
+    instance._previous_tree_path = instance.tree_path
+
+
+@receiver(pre_save, sender=Document)
+def remember_document_placement(sender, instance, raw=False, **kwargs):
+    if raw or instance.pk is None:
+        return
+    instance._previous_placement = (
+        Document.objects.filter(pk=instance.pk).values("folder_id", "size").first()
+    )
+
+
+@receiver(post_save, sender=Document)
+def update_folder_aggregates_on_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+
+    previous = getattr(instance, "_previous_placement", None)
+    instance._previous_placement = {
+        "folder_id": instance.folder_id,
+        "size": instance.size,
+    }
+    if created or previous is None:
+        apply_document_delta(instance.folder_id, 1, instance.size)
+    elif previous["folder_id"] != instance.folder_id:
+        apply_document_delta(previous["folder_id"], -1, -previous["size"])
+        apply_document_delta(instance.folder_id, 1, instance.size)
+    else:
+        apply_document_delta(instance.folder_id, 0, instance.size - previous["size"])
+
+
+def deleted_folder_ids(origin):
+    """
+    Ids of all folders that the delete started by ``origin`` removes, or
+    ``None`` when it did not start at folders. Computed once per delete.
+    """
+    if isinstance(origin, Folder):
+        roots = [origin]
+    elif isinstance(origin, QuerySet) and origin.model is Folder:
+        roots = list(origin)
+    else:
+        return None
+
+    if not hasattr(origin, "_deleted_folder_ids"):
+        subtrees = [Q(tree_path__startswith=root.tree_path) for root in roots]
+        origin._deleted_folder_ids = (
+            set(
+                Folder.objects.filter(reduce(or_, subtrees)).values_list(
+                    "id", flat=True
+                )
+            )
+            if subtrees
+            else set()
+        )
+    return origin._deleted_folder_ids
+
+
+@receiver(pre_delete, sender=Folder)
+def update_folder_aggregates_on_folder_delete(sender, instance, origin=None, **kwargs):
+    deleted = deleted_folder_ids(origin) or set()
+    if instance.parent_id in deleted:
+        # the top of the deleted subtree accounts for it
+        return
+
+    row = (
+        Folder.objects.filter(pk=instance.pk)
+        .values("tree_path", "subtree_document_count", "subtree_size")
+        .first()
+    )
+    if row is None:
+        return
+    ancestor_ids = parse_tree_path(row["tree_path"])[:-1]
+    if ancestor_ids:
+        Folder.objects.filter(pk__in=ancestor_ids).update(
+            subtree_document_count=F("subtree_document_count")
+            - row["subtree_document_count"],
+            subtree_size=F("subtree_size") - row["subtree_size"],
+            subtree_last_modified=timezone.now(),
+        )
+    invalidate_folder_cache(ancestor_ids + [instance.pk])
+
+
+@receiver(post_delete, sender=Document)
+def update_folder_aggregates_on_delete(sender, instance, origin=None, **kwargs):
+    deleted = deleted_folder_ids(origin)
+    if deleted and instance.folder_id in deleted:
+        # already taken off the ancestors together with its folder
+        return
+    apply_document_delta(instance.folder_id, -1, -instance.size)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class DocumentStoreConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "document_store"
+
+    def ready(self):
+        # registers signal receivers
+        from . import access, aggregates, paths, revisions  # noqa: F401
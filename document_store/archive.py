@@ -0,0 +1,127 @@
+import os
+import zipfile
+
+from django.db.models import Q
+
+from .aggregates import parse_tree_path
+from .models import Document, Folder
+
+# formats whose payload is already compressed, deflating them again only
+# costs cpu time
+COMPRESSED_EXTENSIONS = {
+    ".7z", ".avi", ".bz2", ".docx", ".epub", ".flac", ".gif", ".gz", ".heic",
+    ".jar", ".jpeg", ".jpg", ".m4a", ".mkv", ".mov", ".mp3", ".mp4", ".odp",
+    ".ods", ".odt", ".ogg", ".png", ".pptx", ".rar", ".tgz", ".webm", ".webp",
+    ".xlsx", ".xz", ".zip", ".zst",
+}  # fmt: skip
+COMPRESSED_CONTENT_TYPES = ("image/", "video/", "audio/")
+UNCOMPRESSED_CONTENT_TYPES = ("image/bmp", "image/svg+xml", "audio/wav")
+
+CHUNK_SIZE = 64 * 1024
+
+
+def is_compressed(document):
+    extension = os.path.splitext(document.file.name)[1].lower()
+    if extension in COMPRESSED_EXTENSIONS:
+        return True
+    content_type = document.content_type
+    return content_type.startswith(COMPRESSED_CONTENT_TYPES) and (
+        content_type not in UNCOMPRESSED_CONTENT_TYPES
+    )
+
+
+def safe_name(name):
+    return name.replace("/", "_").replace("\\", "_") or "_"
+
+
+class ZipStream:
+    """
+    Write only file object handed to ``ZipFile``. Everything written is
+    kept until the next ``drain()``, so at most one chunk is held at a time.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self._chunks = self._chunks, []
+        return chunks
+
+
+def folder_paths(root, visible=Q()):
+    """
+    Map every folder below ``root`` to its path inside the archive. Folders
+    below one that ``visible`` hides are left out, even when they are
+    visible themselves, so that hidden names never appear in a path.
+    """
+    folders = Folder.objects.filter(visible, tree_path__startswith=root.tree_path)
+    rows = list(folders.values_list("id", "name", "tree_path"))
+    names = {folder_id: safe_name(name) for folder_id, name, _ in rows}
+    skip = len(parse_tree_path(root.tree_path)) - 1
+    paths = {}
+    for folder_id, _, tree_path in rows:
+        chain = parse_tree_path(tree_path)[skip:]
+        if all(pk in names for pk in chain):
+            paths[folder_id] = "/".join(names[pk] for pk in chain)
+    return paths
+
+
+def stream_folder_archive(root, visible=Q()):
+    """
+    Yield a ZIP archive of ``root`` and everything below it piece by piece.
+    Entries are written with data descriptors, so neither the archive nor a
+    member ever has to be held in memory or seeked back into. Folders not
+    matched by ``visible`` are left out together with their documents.
+    """
+    stream = ZipStream()
+    paths = folder_paths(root, visible)
+    used_names = set()
+
+    with zipfile.ZipFile(stream, mode="w", allowZip64=True) as archive:
+        for folder_id in sorted(paths, key=paths.get):
+            archive.writestr(zipfile.ZipInfo(f"{paths[folder_id]}/"), b"")
+            yield from stream.drain()
+
+        documents = (
+            Document.objects.filter(folder__tree_path__startswith=root.tree_path)
+            .exclude(file="")
+            .order_by("folder_id", "name")
+            .iterator()
+        )
+        for document in documents:
+            # filtered here rather than with one query parameter per folder
+            if document.folder_id not in paths:
+                continue
+            name = f"{paths[document.folder_id]}/{safe_name(document.name)}"
+            base, extension = os.path.splitext(name)
+            copy = 1
+            while name in used_names:
+                copy += 1
+                name = f"{base} ({copy}){extension}"
+            used_names.add(name)
+
+            entry = zipfile.ZipInfo(name)
+            entry.compress_type = (
+                zipfile.ZIP_STORED if is_compressed(document) else zipfile.ZIP_DEFLATED
+            )
+            with document.file.open("rb") as source, archive.open(
+                entry, mode="w", force_zip64=True
+            ) as target:
+                for chunk in source.chunks(CHUNK_SIZE):
+                    target.write(chunk)
+                    yield from stream.drain()
+            yield from stream.drain()
+
+    yield from stream.drain()
@@ -1,3 +1,8 @@
+import time
+
+from django.core.cache import cache
+
+
 class CacheKeys:
     # Cache keys for list views
     TOPIC_LIST_KEY = "topic_list"
@@ -8,3 +13,40 @@ class CacheKeys:
     TOPIC_DETAIL_KEY_PREFIX = "topic_detail_"
     FOLDER_DETAIL_KEY_PREFIX = "folder_detail_"
     DOCUMENT_DETAIL_KEY_PREFIX = "document_detail_"
+
+    # Bumped on every change, expires all responses cached for a non default
+    # ?fields= / ?expand= shape, filter, page or facets at once
+    SHAPE_GENERATION_KEY = "shape_generation"
+
+    # Resolved folder permissions of a user, bumping the generation expires
+    # the entries of all users
+    FOLDER_GRANTS_KEY_PREFIX = "folder_grants_"
+    FOLDER_GRANTS_GENERATION_KEY = "folder_grants_generation"
+
+
+def get_generation(key):
+    # starts from the clock rather than 0, so that a cleared cache never
+    # brings back a generation that entries kept elsewhere were stored under
+    return cache.get_or_set(key, time.time_ns, None)
+
+
+def bump_generation(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, None)
+
+
+def shaped_cache_key(key, shape, scope="", query=""):
+    """
+    Key of a response for a non default ``shape``, access ``scope`` or
+    remaining ``query`` string; the default response keeps the plain ``key``.
+    """
+    if not shape.cache_key and not scope and not query:
+        return key
+    generation = get_generation(CacheKeys.SHAPE_GENERATION_KEY)
+    return f"{key}:{generation}:{scope}:{shape.cache_key}:{query}"
+
+
+def expire_shaped_cache():
+    bump_generation(CacheKeys.SHAPE_GENERATION_KEY)
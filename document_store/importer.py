@@ -0,0 +1,257 @@
+import mimetypes
+import tarfile
+import zipfile
+from collections import defaultdict, namedtuple
+
+from django.core.cache import cache
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files import File
+from django.db import transaction
+
+from .access import can_write
+from .aggregates import (
+    apply_document_delta,
+    build_tree_path,
+    invalidate_folder_cache,
+    parse_tree_path,
+)
+from .cache_manager import CacheKeys, expire_shaped_cache
+from .models import Document, Folder
+from .paths import build_name_path
+
+BATCH_SIZE = 500
+FORBIDDEN = "You cannot write to this folder."
+
+ArchiveEntry = namedtuple("ArchiveEntry", ["path", "is_dir", "size", "open"])
+
+
+class ArchiveImportError(Exception):
+    pass
+
+
+class ImportReport:
+    def __init__(self, total):
+        self.total = total
+        self.processed = 0
+        self.folders_created = 0
+        self.documents_created = 0
+        self.bytes_imported = 0
+        self.errors = []
+
+    def as_dict(self):
+        return {
+            "total": self.total,
+            "processed": self.processed,
+            "folders_created": self.folders_created,
+            "documents_created": self.documents_created,
+            "bytes_imported": self.bytes_imported,
+            "errors": self.errors,
+        }
+
+
+def read_entries(archive_file):
+    """
+    List the members of a ZIP or tar (optionally compressed) archive.
+    Only headers are read here, contents are opened lazily per entry.
+    """
+    if zipfile.is_zipfile(archive_file):
+        archive_file.seek(0)
+        archive = zipfile.ZipFile(archive_file)
+        return [
+            ArchiveEntry(
+                path=info.filename,
+                is_dir=info.is_dir(),
+                size=info.file_size,
+                open=lambda info=info: archive.open(info),
+            )
+            for info in archive.infolist()
+        ]
+
+    archive_file.seek(0)
+    try:
+        archive = tarfile.open(fileobj=archive_file, mode="r:*")
+    except tarfile.TarError as exc:
+        raise ArchiveImportError("Not a ZIP or tar archive.") from exc
+    return [
+        ArchiveEntry(
+            path=member.name,
+            is_dir=member.isdir(),
+            size=member.size,
+            open=lambda member=member: archive.extractfile(member),
+        )
+        for member in archive.getmembers()
+        if member.isdir() or member.isfile()
+    ]
+
+
+def clean_path(path):
+    """Normalise an entry path, refusing absolute paths and ``..``."""
+    parts = [
+        part for part in path.replace("\\", "/").split("/") if part not in ("", ".")
+    ]
+    if not parts or path.startswith("/") or ".." in parts:
+        return None
+    return parts
+
+
+def ensure_folders(root, directories, report, user=None):
+    """
+    Create every missing folder below ``root`` with one bulk insert per
+    tree level and return a mapping of relative path to folder id.
+
+    With a ``user``, only folders that the user can write are returned and
+    no folders are created inside the others.
+    """
+    rows = list(
+        Folder.objects.filter(tree_path__startswith=root.tree_path).only(
+            "id", "name", "tree_path", "restricted", "name_path"
+        )
+    )
+    names = {folder.pk: folder.name for folder in rows}
+    skip = len(parse_tree_path(root.tree_path))
+    existing = {
+        tuple(names[pk] for pk in parse_tree_path(folder.tree_path)[skip:]): folder
+        for folder in rows
+    }
+    locked = set()
+    if user is not None:
+        locked = {
+            parts for parts, folder in existing.items() if not can_write(user, folder)
+        }
+        existing = {
+            parts: folder for parts, folder in existing.items() if parts not in locked
+        }
+
+    wanted = set()
+    for parts in directories:
+        for depth in range(1, len(parts) + 1):
+            wanted.add(tuple(parts[:depth]))
+
+    missing = sorted(wanted - existing.keys() - locked, key=len)
+    parent_ids = set()
+    for depth in sorted({len(parts) for parts in missing}):
+        # folders inside ones the user cannot write are not created
+        level = [
+            parts for parts in missing if len(parts) == depth and parts[:-1] in existing
+        ]
+        folders = Folder.objects.bulk_create(
+            [
+                Folder(
+                    name=parts[-1],
+                    parent_id=existing[parts[:-1]].pk,
+                    restricted=existing[parts[:-1]].restricted,
+                    name_path=build_name_path(
+                        existing[parts[:-1]].name_path, parts[-1]
+                    ),
+                )
+                for parts in level
+            ]
+        )
+        for parts, folder in zip(level, folders):
+            folder.tree_path = build_tree_path(
+                existing[parts[:-1]].tree_path, folder.pk
+            )
+            existing[parts] = folder
+            parent_ids.add(folder.parent_id)
+        Folder.objects.bulk_update(folders, ["tree_path"], batch_size=BATCH_SIZE)
+        report.folders_created += len(folders)
+
+    if parent_ids:
+        # their cached children lists miss the new folders
+        invalidate_folder_cache(parent_ids)
+    return {parts: folder.pk for parts, folder in existing.items()}
+
+
+def import_archive(archive_file, root, topic=None, progress=None, user=None):
+    """
+    Recreate the folders and files of ``archive_file`` below ``root``.
+
+    Every file is streamed from the archive straight into storage, rows are
+    written with bulk inserts and folder aggregates are updated once per
+    folder of each batch, together with its insert. Failures of single entries, including entries inside folders
+    that ``user`` cannot write, are collected in the report instead of
+    aborting the import.
+    """
+    entries = read_entries(archive_file)
+    report = ImportReport(len(entries))
+
+    files = []
+    directories = set()
+    directory_entries = []
+    for entry in entries:
+        parts = clean_path(entry.path)
+        if parts is None:
+            report.errors.append({"entry": entry.path, "error": "Unsafe path."})
+        elif entry.is_dir:
+            directories.add(tuple(parts))
+            directory_entries.append((entry, parts))
+        else:
+            directories.add(tuple(parts[:-1]))
+            files.append((entry, parts))
+    report.processed = report.total - len(files)
+
+    folders = ensure_folders(root, directories, report, user)
+    for entry, parts in directory_entries:
+        if tuple(parts) not in folders:
+            report.errors.append({"entry": entry.path, "error": FORBIDDEN})
+    file_field = Document._meta.get_field("file")
+    totals = defaultdict(lambda: [0, 0])
+    pending = []
+
+    def flush():
+        with transaction.atomic():
+            Document.objects.bulk_create(pending)
+            for folder_id, (count, size) in totals.items():
+                apply_document_delta(folder_id, count, size)
+        report.documents_created += len(pending)
+        pending.clear()
+        totals.clear()
+
+    for entry, parts in files:
+        name = parts[-1]
+        try:
+            if tuple(parts[:-1]) not in folders:
+                raise ValueError(FORBIDDEN)
+            if len(name) > Document._meta.get_field("name").max_length:
+                raise ValueError("Name is too long.")
+            document = Document(
+                name=name,
+                folder_id=folders[tuple(parts[:-1])],
+                topic=topic,
+                size=entry.size,
+                content_type=mimetypes.guess_type(name)[0] or "",
+            )
+            with entry.open() as source:
+                content = File(source, name=name)
+                content.size = entry.size
+                document.file.name = file_field.storage.save(
+                    file_field.generate_filename(document, name),
+                    content,
+                    max_length=file_field.max_length,
+                )
+        except (
+            OSError,
+            ValueError,
+            SuspiciousFileOperation,
+            zipfile.BadZipFile,
+            tarfile.TarError,
+        ) as exc:
+            report.errors.append({"entry": entry.path, "error": str(exc)})
+        else:
+            pending.append(document)
+            totals[document.folder_id][0] += 1
+            totals[document.folder_id][1] += document.size
+            report.bytes_imported += document.size
+            if len(pending) >= BATCH_SIZE:
+                flush()
+
+        report.processed += 1
+        if progress is not None:
+            progress(report, entry.path)
+
+    flush()
+
+    cache.delete_many([CacheKeys.FOLDER_LIST_KEY, CacheKeys.DOCUMENT_LIST_KEY])
+    expire_shaped_cache()
+
+    return report
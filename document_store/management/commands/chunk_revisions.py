@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from document_store.revisions import chunk_pending_revisions
+
+
+class Command(BaseCommand):
+    help = (
+        "Move the files of revisions that a newer file replaced into the "
+        "chunk store. Run it regularly, e.g. from cron."
+    )
+
+    def handle(self, *args, **options):
+        count = chunk_pending_revisions()
+        self.stdout.write(self.style.SUCCESS(f"Chunked {count} revision(s)."))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from document_store.models import Document
+
+
+class Command(BaseCommand):
+    help = "Compress document files that were stored before compression at rest."
+
+    def handle(self, *args, **options):
+        storage = Document._meta.get_field("file").storage
+        if not hasattr(storage, "compress_existing"):
+            self.stderr.write("The default storage does not compress files.")
+            return
+
+        compressed = 0
+        saved = 0
+        names = (
+            Document.objects.exclude(file="").values_list("file", flat=True).iterator()
+        )
+        for name in names:
+            try:
+                sizes = storage.compress_existing(name)
+            except OSError as exc:
+                self.stderr.write(f"{name}: {exc}")
+                continue
+            if sizes is not None:
+                compressed += 1
+                saved += sizes[0] - sizes[1]
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Compressed {compressed} file(s), saved {saved} bytes.")
+        )
@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from document_store.importer import ArchiveImportError, import_archive
+from document_store.models import Folder, Topic
+from document_store.slack import notify_slack_on_import
+
+
+class Command(BaseCommand):
+    help = "Import a ZIP or tar archive into a folder, recreating its tree."
+
+    def add_arguments(self, parser):
+        parser.add_argument("archive", help="Path of the ZIP or tar archive.")
+        parser.add_argument(
+            "--folder", type=int, required=True, help="Id of the target folder."
+        )
+        parser.add_argument("--topic", type=int, help="Id of a topic to assign.")
+        parser.add_argument(
+            "--no-notify",
+            action="store_true",
+            help="Skip the Slack summary notification.",
+        )
+
+    def handle(self, *args, **options):
+        self.verbosity = options["verbosity"]
+        try:
+            folder = Folder.objects.get(pk=options["folder"])
+            topic = options["topic"] and Topic.objects.get(pk=options["topic"])
+        except (Folder.DoesNotExist, Topic.DoesNotExist) as exc:
+            raise CommandError(str(exc))
+
+        try:
+            with open(options["archive"], "rb") as archive_file:
+                report = import_archive(
+                    archive_file, folder, topic=topic or None, progress=self.progress
+                )
+        except (OSError, ArchiveImportError) as exc:
+            raise CommandError(str(exc))
+
+        for error in report.errors:
+            self.stderr.write(f"{error['entry']}: {error['error']}")
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Created {report.folders_created} folder(s) and "
+                f"{report.documents_created} document(s), "
+                f"{len(report.errors)} error(s)."
+            )
+        )
+
+        if not options["no_notify"]:
+            notify_slack_on_import(folder, report)
+
+    def progress(self, report, entry):
+        if (
+            self.verbosity > 1
+            or report.processed % 100 == 0
+            or report.processed == report.total
+        ):
+            self.stdout.write(f"[{report.processed}/{report.total}] {entry}")
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from document_store.models import Chunk, Document, DocumentRevision
+from document_store.revisions import chunk_path
+
+
+class Command(BaseCommand):
+    help = "Delete revision chunks that no revision refers to any more."
+
+    def handle(self, *args, **options):
+        storage = Document._meta.get_field("file").storage
+        referenced = set()
+        for chunks in DocumentRevision.objects.values_list(
+            "chunks", flat=True
+        ).iterator():
+            referenced.update(chunks)
+
+        unused = [
+            digest
+            for digest in Chunk.objects.values_list("digest", flat=True).iterator()
+            if digest not in referenced
+        ]
+        for digest in unused:
+            storage.delete(chunk_path(digest))
+        for start in range(0, len(unused), 500):
+            Chunk.objects.filter(pk__in=unused[start : start + 500]).delete()
+
+        self.stdout.write(self.style.SUCCESS(f"Deleted {len(unused)} chunk(s)."))
@@ -0,0 +1,55 @@
+import mimetypes
+
+from django.core.management.base import BaseCommand
+
+from document_store.aggregates import rebuild_folder_aggregates
+from document_store.models import Document
+from document_store.paths import rebuild_folder_paths
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute folder tree paths, name paths and document aggregates to "
+        "repair drift."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--refresh-sizes",
+            action="store_true",
+            help="Re-read size and content type of every document from storage.",
+        )
+
+    def handle(self, *args, **options):
+        if options["refresh_sizes"]:
+            self.refresh_sizes()
+
+        repaired = rebuild_folder_aggregates()
+        self.stdout.write(
+            self.style.SUCCESS(f"Repaired aggregates of {repaired} folder(s).")
+        )
+        repaired = rebuild_folder_paths()
+        self.stdout.write(
+            self.style.SUCCESS(f"Repaired paths of {repaired} folder(s).")
+        )
+
+    def refresh_sizes(self):
+        changed = []
+        for document in Document.objects.exclude(file="").iterator():
+            try:
+                size = document.file.size
+            except OSError:
+                self.stderr.write(f"Missing file for document {document.pk}")
+                continue
+            content_type = (
+                document.content_type
+                or mimetypes.guess_type(document.file.name)[0]
+                or ""
+            )
+            if (size, content_type) != (document.size, document.content_type):
+                document.size = size
+                document.content_type = content_type
+                changed.append(document)
+
+        Document.objects.bulk_update(changed, ["size", "content_type"], batch_size=500)
+        self.stdout.write(f"Refreshed size of {len(changed)} document(s).")
@@ -0,0 +1,101 @@
+# Generated by Django 4.2.1 on 2023-05-28 10:12
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def rebuild_aggregates(apps, schema_editor):
+    from document_store.aggregates import rebuild_folder_aggregates
+
+    rebuild_folder_aggregates(
+        folder_model=apps.get_model("document_store", "Folder"),
+        document_model=apps.get_model("document_store", "Document"),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("document_store", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="document",
+            name="content_type",
+            field=models.CharField(
+                blank=True, default="", editable=False, max_length=255
+            ),
+        ),
+        migrations.AddField(
+            model_name="document",
+            name="modified_at",
+            field=models.DateTimeField(
+                auto_now=True, default=django.utils.timezone.now
+            ),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name="document",
+            name="size",
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="folder",
+            name="document_count",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="folder",
+            name="last_modified",
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="folder",
+            name="subtree_document_count",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="folder",
+            name="subtree_last_modified",
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="folder",
+            name="subtree_size",
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="folder",
+            name="total_size",
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="folder",
+            name="tree_path",
+            field=models.CharField(
+                blank=True, db_index=True, default="", editable=False, max_length=1024
+            ),
+        ),
+        migrations.AlterField(
+            model_name="document",
+            name="file",
+            field=models.FileField(upload_to="static/upload/"),
+        ),
+        migrations.AlterField(
+            model_name="document",
+            name="name",
+            field=models.CharField(max_length=200),
+        ),
+        migrations.AlterField(
+            model_name="folder",
+            name="name",
+            field=models.CharField(max_length=200),
+        ),
+        migrations.AlterField(
+            model_name="topic",
+            name="name",
+            field=models.CharField(max_length=200),
+        ),
+        migrations.RunPython(rebuild_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,81 @@
+# Generated by Django 4.2.1 on 2023-06-02 14:05
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("auth", "0012_alter_user_first_name_max_length"),
+        ("document_store", "0003_document_revisions"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="folder",
+            name="restricted",
+            field=models.BooleanField(db_index=True, default=False, editable=False),
+        ),
+        migrations.CreateModel(
+            name="FolderPermission",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "access",
+                    models.CharField(
+                        choices=[("read", "Read"), ("write", "Read and write")],
+                        default="read",
+                        max_length=5,
+                    ),
+                ),
+                (
+                    "folder",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="permissions",
+                        to="document_store.folder",
+                    ),
+                ),
+                (
+                    "group",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="folder_permissions",
+                        to="auth.group",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="folder_permissions",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="folderpermission",
+            constraint=models.CheckConstraint(
+                check=models.Q(
+                    ("user__isnull", True), ("group__isnull", True), _connector="XOR"
+                ),
+                name="folder_permission_user_or_group",
+            ),
+        ),
+    ]
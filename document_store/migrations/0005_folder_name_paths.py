@@ -0,0 +1,33 @@
+# Generated by Django 4.2.1 on 2023-06-04 11:37
+
+from django.db import migrations, models
+
+
+def rebuild_paths(apps, schema_editor):
+    from document_store.paths import rebuild_folder_paths
+
+    rebuild_folder_paths(folder_model=apps.get_model("document_store", "Folder"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("document_store", "0004_folder_permissions"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="folder",
+            name="name_path",
+            field=models.CharField(
+                blank=True, db_index=True, default="", editable=False, max_length=2048
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="document",
+            index=models.Index(
+                fields=["folder", "name"], name="document_st_folder__dbd757_idx"
+            ),
+        ),
+        migrations.RunPython(rebuild_paths, migrations.RunPython.noop),
+    ]
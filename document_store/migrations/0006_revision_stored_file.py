@@ -0,0 +1,18 @@
+# Generated by Django 4.2.1 on 2023-06-06 09:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("document_store", "0005_folder_name_paths"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="documentrevision",
+            name="stored_file",
+            field=models.CharField(blank=True, default="", max_length=255),
+        ),
+    ]
@@ -1,3 +1,5 @@
+from django.conf import settings
+from django.contrib.auth.models import Group
 from django.db import models
 
 
@@ -9,6 +11,19 @@ class Topic(models.Model):
 
 
 class Folder(models.Model):
+    # maintained incrementally by aggregates.py
+    AGGREGATE_FIELDS = (
+        "tree_path",
+        "document_count",
+        "total_size",
+        "last_modified",
+        "subtree_document_count",
+        "subtree_size",
+        "subtree_last_modified",
+    )
+    # never written by save()
+    MANAGED_FIELDS = AGGREGATE_FIELDS + ("restricted", "name_path")
+
     name = models.CharField(max_length=200)
     parent = models.ForeignKey(
         "self",
@@ -17,6 +32,39 @@ class Folder(models.Model):
         blank=True,
         related_name="child_folders",
     )
+    # ids from the root down to this folder, e.g. "1/5/9/"
+    tree_path = models.CharField(
+        max_length=1024, db_index=True, blank=True, default="", editable=False
+    )
+
+    # aggregates over documents stored directly in this folder
+    document_count = models.PositiveIntegerField(default=0, editable=False)
+    total_size = models.PositiveBigIntegerField(default=0, editable=False)
+    last_modified = models.DateTimeField(null=True, blank=True, editable=False)
+
+    # aggregates over documents in this folder and all of its sub folders
+    subtree_document_count = models.PositiveIntegerField(default=0, editable=False)
+    subtree_size = models.PositiveBigIntegerField(default=0, editable=False)
+    subtree_last_modified = models.DateTimeField(null=True, blank=True, editable=False)
+
+    # whether this folder or one of its parents has access control entries,
+    # maintained by access.py
+    restricted = models.BooleanField(default=False, db_index=True, editable=False)
+
+    # names from the root down to this folder, e.g. "finance/2024/q3",
+    # maintained by paths.py
+    name_path = models.CharField(
+        max_length=2048, db_index=True, blank=True, default="", editable=False
+    )
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.MANAGED_FIELDS
+            ]
+        super().save(*args, **kwargs)
 
     def __str__(self):
         name = self.name
@@ -43,6 +91,85 @@ class Document(models.Model):
         related_name="documents",
     )
     file = models.FileField(upload_to="static/upload/")
+    size = models.PositiveBigIntegerField(default=0, editable=False)
+    content_type = models.CharField(
+        max_length=255, blank=True, default="", editable=False
+    )
+    modified_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["folder", "name"])]
 
     def __str__(self):
         return f"{self.folder}/{self.name}"
+
+
+class Chunk(models.Model):
+    # sha256 of the chunk, its bytes are stored under chunks/<digest>
+    digest = models.CharField(max_length=64, primary_key=True)
+    size = models.PositiveIntegerField()
+
+    def __str__(self):
+        return self.digest
+
+
+class DocumentRevision(models.Model):
+    document = models.ForeignKey(
+        Document, on_delete=models.CASCADE, related_name="revisions"
+    )
+    number = models.PositiveIntegerField()
+    file_name = models.CharField(max_length=200)
+    size = models.PositiveBigIntegerField(default=0)
+    content_type = models.CharField(max_length=255, blank=True, default="")
+    # ordered digests of the chunks that make up the content
+    chunks = models.JSONField(default=list)
+    # storage name of the file that holds the content until it is chunked
+    stored_file = models.CharField(max_length=255, blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["-number"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["document", "number"], name="unique_document_revision"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.document} @{self.number}"
+
+
+class FolderPermission(models.Model):
+    READ = "read"
+    WRITE = "write"
+    ACCESS_CHOICES = [(READ, "Read"), (WRITE, "Read and write")]
+
+    folder = models.ForeignKey(
+        Folder, on_delete=models.CASCADE, related_name="permissions"
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name="folder_permissions",
+    )
+    group = models.ForeignKey(
+        Group,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name="folder_permissions",
+    )
+    access = models.CharField(max_length=5, choices=ACCESS_CHOICES, default=READ)
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                check=models.Q(user__isnull=True) ^ models.Q(group__isnull=True),
+                name="folder_permission_user_or_group",
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.user or self.group} can {self.access} {self.folder}"
@@ -0,0 +1,194 @@
+import threading
+from collections import OrderedDict
+
+from django.db.models import Value
+from django.db.models.functions import Concat, Substr
+from django.db.models.signals import post_save, pre_save
+from django.dispatch import receiver
+
+from .access import access_scope, visible_folders
+from .cache_manager import CacheKeys, get_generation
+from .models import Document, Folder
+
+RESOLVE_CACHE_SIZE = 1024
+MAX_RESOLVE_PATHS = 500
+
+
+def build_name_path(parent_path, name):
+    return f"{parent_path}/{name}" if parent_path else name
+
+
+def clean_path(path):
+    """Normalise ``a//b/`` and ``/a/b`` to ``a/b``."""
+    return "/".join(part for part in path.split("/") if part)
+
+
+def rebuild_folder_paths(folder_model=Folder):
+    """
+    Recompute the name path of every folder from scratch.
+
+    Returns the number of folders whose stored path had drifted.
+    """
+    folders = {folder.pk: folder for folder in folder_model.objects.all()}
+    paths = {}
+
+    def resolve(pk):
+        chain = []
+        while pk is not None and pk not in paths:
+            chain.append(pk)
+            pk = folders[pk].parent_id
+        parent_path = paths.get(pk, "")
+        for pk in reversed(chain):
+            parent_path = paths[pk] = build_name_path(parent_path, folders[pk].name)
+        return parent_path
+
+    changed = []
+    for pk, folder in folders.items():
+        if folder.name_path != resolve(pk):
+            folder.name_path = paths[pk]
+            changed.append(folder)
+
+    folder_model.objects.bulk_update(changed, ["name_path"], batch_size=500)
+    return len(changed)
+
+
+class LRUCache:
+    """A small thread safe least recently used mapping."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# path -> resolution, keyed by the shape generation that every change bumps,
+# so entries of an older generation are never served
+resolved_paths = LRUCache(RESOLVE_CACHE_SIZE)
+
+
+def lookup_paths(user, paths):
+    """
+    Resolve ``paths`` the cache did not know with one query for folders
+    and one for documents, however deep or many the paths are.
+    """
+    parents = {path.rpartition("/")[0] for path in paths if "/" in path}
+    folders = {}
+    rows = (
+        Folder.objects.filter(visible_folders(user), name_path__in=set(paths) | parents)
+        .order_by("-id")
+        .values_list("name_path", "id")
+    )
+    for name_path, folder_id in rows:
+        folders[name_path] = folder_id  # the oldest folder wins
+
+    wanted = {}
+    for path in paths:
+        parent, _, name = path.rpartition("/")
+        if path not in folders and parent in folders:
+            wanted[(folders[parent], name)] = path
+
+    documents = {}
+    if wanted:
+        rows = (
+            Document.objects.filter(
+                folder_id__in={folder_id for folder_id, _ in wanted},
+                name__in={name for _, name in wanted},
+            )
+            .order_by("-id")
+            .values_list("folder_id", "name", "id")
+        )
+        for folder_id, name, document_id in rows:
+            if (folder_id, name) in wanted:
+                documents[wanted[(folder_id, name)]] = document_id
+
+    results = {}
+    for path in paths:
+        if path in folders:
+            results[path] = {"type": "folder", "id": folders[path]}
+        elif path in documents:
+            results[path] = {"type": "document", "id": documents[path]}
+        else:
+            results[path] = None
+    return results
+
+
+def resolve_paths(user, paths):
+    """
+    Map each of ``paths`` to ``{"type": "folder" | "document", "id": ...}``,
+    or ``None`` when ``user`` can see nothing there. Folders win over
+    documents of the same path.
+    """
+    generation = get_generation(CacheKeys.SHAPE_GENERATION_KEY)
+    scope = access_scope(user)
+    cleaned = {path: clean_path(path) for path in paths}
+
+    results = {}
+    for path in set(cleaned.values()):
+        cached = resolved_paths.get((generation, scope, path), False)
+        if cached is not False:
+            results[path] = cached
+
+    missing = [path for path in set(cleaned.values()) if path not in results]
+    if missing:
+        found = lookup_paths(user, [path for path in missing if path])
+        found.setdefault("", None)
+        for path in missing:
+            results[path] = found[path]
+            resolved_paths.set((generation, scope, path), found[path])
+
+    return {path: results[cleaned[path]] for path in paths}
+
+
+@receiver(pre_save, sender=Folder)
+def remember_name_path(sender, instance, raw=False, **kwargs):
+    if raw or instance.pk is None:
+        return
+    instance._previous_name_path = (
+        Folder.objects.filter(pk=instance.pk)
+        .values_list("name_path", flat=True)
+        .first()
+    )
+
+
+@receiver(post_save, sender=Folder)
+def update_name_paths(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+
+    parent_path = ""
+    if instance.parent_id is not None:
+        parent_path = (
+            Folder.objects.filter(pk=instance.parent_id)
+            .values_list("name_path", flat=True)
+            .first()
+            or ""
+        )
+    name_path = build_name_path(parent_path, instance.name)
+    previous = getattr(instance, "_previous_name_path", None)
+
+    if created or not previous:
+        Folder.objects.filter(pk=instance.pk).update(name_path=name_path)
+    elif previous != name_path:
+        # renamed or moved, the tree path was already updated by aggregates.py
+        Folder.objects.filter(tree_path__startswith=instance.tree_path).update(
+            name_path=Concat(Value(name_path), Substr("name_path", len(previous) + 1))
+        )
+    instance.name_path = instance._previous_name_path = name_path
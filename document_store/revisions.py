@@ -0,0 +1,250 @@
+import hashlib
+import os
+
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.db.models import Max
+from django.db.models.signals import post_save, pre_save
+from django.dispatch import receiver
+
+from .models import Chunk, Document, DocumentRevision
+from .storage import ChunkedContent
+
+# Content defined chunking with a gear rolling hash (as in FastCDC). A cut is
+# made where the top CUT_BITS bits of the hash are zero, so boundaries move
+# with the content and an edit only changes the chunks it touches.
+MIN_CHUNK_SIZE = 2 * 1024
+MAX_CHUNK_SIZE = 64 * 1024
+CUT_BITS = 13  # 8 KiB average
+CUT_MASK = ((1 << CUT_BITS) - 1) << (64 - CUT_BITS)
+HASH_MASK = (1 << 64) - 1
+GEAR = [
+    int.from_bytes(hashlib.sha256(bytes([value])).digest()[:8], "big")
+    for value in range(256)
+]
+READ_SIZE = 1024 * 1024
+CHUNK_BATCH_SIZE = 256
+
+
+def find_cut(buffer, start, final):
+    """
+    Return the end of the chunk starting at ``start``, or ``None`` when
+    more data is needed to decide.
+    """
+    end = min(len(buffer), start + MAX_CHUNK_SIZE)
+    if len(buffer) - start <= MIN_CHUNK_SIZE:
+        return len(buffer) if final and len(buffer) > start else None
+
+    digest = 0
+    gear = GEAR
+    for position in range(start + MIN_CHUNK_SIZE, end):
+        digest = ((digest << 1) + gear[buffer[position]]) & HASH_MASK
+        if not digest & CUT_MASK:
+            return position + 1
+    if end == start + MAX_CHUNK_SIZE or final:
+        return end
+    return None
+
+
+def iter_chunks(fileobj):
+    """Split a file into content defined chunks while reading it."""
+    buffer = b""
+    while True:
+        block = fileobj.read(READ_SIZE)
+        buffer += block
+        start = 0
+        while True:
+            cut = find_cut(buffer, start, final=not block)
+            if cut is None:
+                break
+            yield buffer[start:cut]
+            start = cut
+        buffer = buffer[start:]
+        if not block:
+            return
+
+
+def chunk_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def chunk_path(digest):
+    return f"chunks/{digest[:2]}/{digest}"
+
+
+def store_chunks(storage, chunks):
+    """
+    Write the chunks that are not in the chunk store yet, a batch at a time,
+    and return the digests of all of them in order.
+    """
+    digests = []
+    batch = {}
+
+    def flush():
+        for digest in missing_chunks(batch):
+            if not storage.exists(chunk_path(digest)):
+                storage.save(chunk_path(digest), ContentFile(batch[digest]))
+        Chunk.objects.bulk_create(
+            [Chunk(digest=digest, size=len(data)) for digest, data in batch.items()],
+            ignore_conflicts=True,
+        )
+        batch.clear()
+
+    for data in chunks:
+        digest = chunk_digest(data)
+        digests.append(digest)
+        batch[digest] = data
+        if len(batch) >= CHUNK_BATCH_SIZE:
+            flush()
+    flush()
+    return digests
+
+
+def missing_chunks(digests):
+    present = set(
+        Chunk.objects.filter(pk__in=set(digests)).values_list("digest", flat=True)
+    )
+    return sorted(set(digests) - present)
+
+
+def iter_chunk_content(digests, storage):
+    for digest in digests:
+        with storage.open(chunk_path(digest)) as chunk:
+            yield chunk.read()
+
+
+def next_revision_number(document):
+    latest = document.revisions.aggregate(latest=Max("number"))["latest"]
+    return (latest or 0) + 1
+
+
+def snapshot(document, file_name, size, content_type, chunks=None):
+    """
+    Record the content of ``file_name`` as the next revision of
+    ``document``. Without ``chunks`` the revision keeps pointing at the
+    file, which is moved into the chunk store once a newer file replaced it.
+    """
+    return DocumentRevision.objects.create(
+        document=document,
+        number=next_revision_number(document),
+        file_name=os.path.basename(file_name),
+        size=size,
+        content_type=content_type,
+        chunks=chunks or [],
+        stored_file=file_name if chunks is None else "",
+    )
+
+
+def release_file(storage, name):
+    """Delete ``name`` once neither a document nor a revision needs it."""
+    if (
+        not Document.objects.filter(file=name).exists()
+        and not DocumentRevision.objects.filter(stored_file=name).exists()
+    ):
+        storage.delete(name)
+
+
+def chunk_revision(revision):
+    """
+    Split the file of a revision into the chunk store and delete the file.
+    Only chunks that no earlier revision stored are written.
+    """
+    name = revision.stored_file
+    if not name:
+        return
+    storage = revision.document.file.storage
+    with storage.open(name) as stored:
+        revision.chunks = store_chunks(storage, iter_chunks(stored))
+    revision.stored_file = ""
+    revision.save(update_fields=["chunks", "stored_file"])
+    release_file(storage, name)
+
+
+def chunk_pending_revisions():
+    """
+    Chunk every revision whose file is no document's head anymore, oldest
+    first. Heads stay whole files, so that they are stored once and can be
+    downloaded compressed.
+    """
+    pending = (
+        DocumentRevision.objects.exclude(stored_file="")
+        .exclude(stored_file__in=Document.objects.values("file"))
+        .select_related("document")
+        .order_by("pk")
+    )
+    count = 0
+    for revision in pending.iterator():
+        chunk_revision(revision)
+        count += 1
+    return count
+
+
+def save_from_chunks(document, file_name, chunks, size):
+    """Assemble ``chunks`` into a new head file of ``document``."""
+    content = ChunkedContent(iter_chunk_content(chunks, document.file.storage))
+    content.size = size
+    document._revision_chunks = chunks
+    document.size = size
+    document.file.save(file_name, content, save=False)
+    document.save()
+
+
+def restore_revision(revision):
+    document = revision.document
+    document.content_type = revision.content_type
+    if not revision.stored_file:
+        save_from_chunks(document, revision.file_name, revision.chunks, revision.size)
+        return document.revisions.first()
+
+    with document.file.storage.open(revision.stored_file) as stored:
+        content = File(stored, revision.file_name)
+        content.size = revision.size
+        document.size = revision.size
+        document.file.save(revision.file_name, content, save=False)
+    document.save()
+    return document.revisions.first()
+
+
+@receiver(pre_save, sender=Document)
+def remember_head_file(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    instance._previous_head = None
+    if instance.pk is not None:
+        instance._previous_head = (
+            Document.objects.filter(pk=instance.pk)
+            .values("file", "size", "content_type")
+            .first()
+        )
+
+
+@receiver(post_save, sender=Document)
+def record_revision(sender, instance, created, raw=False, **kwargs):
+    if raw or not instance.file:
+        return
+    head = getattr(instance, "_previous_head", None) or {}
+    previous = head.get("file")
+    if previous == instance.file.name:
+        return
+
+    if previous and not instance.revisions.exists():
+        # documents stored before versioning, e.g. by bulk imports
+        snapshot(instance, previous, head["size"], head["content_type"])
+    snapshot(
+        instance,
+        instance.file.name,
+        instance.size,
+        instance.content_type,
+        getattr(instance, "_revision_chunks", None),
+    )
+    instance._revision_chunks = None
+    instance._previous_head = {
+        "file": instance.file.name,
+        "size": instance.size,
+        "content_type": instance.content_type,
+    }
+
+    # the replaced head is kept until ``manage.py chunk_revisions`` moved it
+    # into the chunk store, unless it is there already
+    if previous:
+        release_file(instance.file.storage, previous)
@@ -1,19 +1,150 @@
+import mimetypes
+from collections import namedtuple
+
+from django.db import models
+from django.urls import reverse
 from rest_framework import serializers
 
-from .models import Document, Folder, Topic
+from .aggregates import parse_tree_path
+from .models import Document, DocumentRevision, Folder, FolderPermission, Topic
+
+
+def split_param(value):
+    return frozenset(item.strip() for item in value.split(",") if item.strip())
+
+
+class Shape(namedtuple("Shape", ["fields", "expand"])):
+    """
+    The response shape requested with ``?fields=`` and ``?expand=``.
+
+    ``fields`` is ``None`` when every field was requested, ``expand`` holds
+    dotted paths such as ``folder.path``.
+    """
+
+    @classmethod
+    def from_request(cls, request, serializer_class):
+        fields = request.query_params.get("fields")
+        shape = cls(
+            fields=split_param(fields) if fields is not None else None,
+            expand=split_param(request.query_params.get("expand", "")),
+        )
+        unknown = sorted(
+            path for path in shape.expand if not serializer_class.can_expand(path)
+        )
+        if unknown:
+            raise serializers.ValidationError(
+                {"expand": f"Cannot expand {', '.join(unknown)}."}
+            )
+        return shape
+
+    def nested(self, name):
+        prefix = f"{name}."
+        return frozenset(
+            path[len(prefix) :] for path in self.expand if path.startswith(prefix)
+        )
+
+    def expands(self, name):
+        return name in self.expand or bool(self.nested(name))
+
+    def includes(self, name):
+        return self.fields is None or name in self.fields or self.expands(name)
+
+    @property
+    def cache_key(self):
+        if self.fields is None and not self.expand:
+            return ""
+        fields = "*" if self.fields is None else ",".join(sorted(self.fields))
+        return f"fields={fields}&expand={','.join(sorted(self.expand))}"
+
+
+DEFAULT_SHAPE = Shape(fields=None, expand=frozenset())
+
+
+class ShapedSerializerMixin:
+    """
+    Drops fields that were not asked for and replaces the related ids
+    listed in ``expansions`` with nested representations.
+    """
+
+    # field name -> names that can in turn be expanded on the nested object
+    expansions = {}
+    # field name -> serializer class that renders the expanded object
+    expanded_serializers = {}
+    # fields rendered when nested into another serializer, ``None`` for all
+    nested_fields = None
+
+    def __init__(self, *args, shape=DEFAULT_SHAPE, **kwargs):
+        self.shape = shape
+        super().__init__(*args, **kwargs)
+
+    @classmethod
+    def can_expand(cls, path):
+        name, _, rest = path.partition(".")
+        return name in cls.expansions and (not rest or rest in cls.expansions[name])
+
+    def get_expanded_field(self, name, nested_expand):
+        serializer_class = self.expanded_serializers[name]
+        return serializer_class(
+            read_only=True,
+            shape=Shape(fields=serializer_class.nested_fields, expand=nested_expand),
+        )
+
+    def get_fields(self):
+        fields = super().get_fields()
+        if self.shape.fields is not None:
+            fields = {
+                name: field
+                for name, field in fields.items()
+                if name in self.shape.fields
+            }
+        for name in self.expansions:
+            if self.shape.expands(name):
+                fields[name] = self.get_expanded_field(name, self.shape.nested(name))
+        return fields
+
+
+class FolderPathField(serializers.Field):
+    """
+    Full ``a/b/c`` path of a folder. Names are looked up in the shared
+    ``folder_names`` context dict, which views preload for a whole page.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs["source"] = "*"
+        kwargs["read_only"] = True
+        super().__init__(**kwargs)
 
+    def to_representation(self, folder):
+        names = self.context.setdefault("folder_names", {})
+        ids = parse_tree_path(folder.tree_path)
+        load_folder_names(names, ids)
+        return "/".join(names[pk] for pk in ids)
 
-class TopicSerializer(serializers.ModelSerializer):
+
+def load_folder_names(names, folder_ids):
+    missing = set(folder_ids) - names.keys()
+    if missing:
+        names.update(Folder.objects.filter(pk__in=missing).values_list("id", "name"))
+
+
+def folder_field_names():
+    return frozenset(field.name for field in Folder._meta.concrete_fields)
+
+
+class TopicSerializer(ShapedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Topic
         fields = "__all__"
 
 
-class FolderSerializer(serializers.ModelSerializer):
+class FolderSerializer(ShapedSerializerMixin, serializers.ModelSerializer):
     children = (
         serializers.SerializerMethodField()
     )  # consists of files and nested folders
 
+    expansions = {"parent": ("path",), "path": ()}
+    nested_fields = folder_field_names()
+
     def get_children(self, instance):
         children = [
             {"name": child.name, "type": "folder"}
@@ -25,12 +156,94 @@ class FolderSerializer(serializers.ModelSerializer):
         ]
         return children
 
+    def get_expanded_field(self, name, nested_expand):
+        if name == "path":
+            return FolderPathField()
+        return FolderSerializer(
+            read_only=True,
+            shape=Shape(fields=self.nested_fields, expand=nested_expand),
+        )
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # preloaded by the views for users who cannot see the whole subtree
+        visible = self.context.get("visible_aggregates", {}).get(instance.pk, {})
+        for name, value in visible.items():
+            if name in data:
+                data[name] = self.fields[name].to_representation(value)
+        return data
+
+    def validate_parent(self, parent):
+        if (
+            parent is not None
+            and self.instance is not None
+            and self.instance.tree_path
+            and parent.tree_path.startswith(self.instance.tree_path)
+        ):
+            raise serializers.ValidationError(
+                "A folder cannot be moved into itself or one of its sub folders."
+            )
+        return parent
+
     class Meta:
         model = Folder
-        fields = "__all__"
+        exclude = ["name_path"]
+
 
+class DocumentFileField(serializers.FileField):
+    """
+    Accepts uploads like a ``FileField`` but links to the download endpoint,
+    as stored files may be compressed and only the endpoint decodes them.
+    """
+
+    def to_representation(self, value):
+        if not value:
+            return None
+        url = reverse("document-download", args=[value.instance.pk])
+        request = self.context.get("request")
+        if request is not None:
+            return request.build_absolute_uri(url)
+        return url
+
+
+class DocumentSerializer(ShapedSerializerMixin, serializers.ModelSerializer):
+    serializer_field_mapping = {
+        **serializers.ModelSerializer.serializer_field_mapping,
+        models.FileField: DocumentFileField,
+    }
+    expansions = {"folder": ("path",), "topic": ()}
+    expanded_serializers = {"folder": FolderSerializer, "topic": TopicSerializer}
+
+    def validate(self, attrs):
+        upload = attrs.get("file")
+        if upload is not None:
+            attrs["size"] = upload.size
+            attrs["content_type"] = (
+                getattr(upload, "content_type", None)
+                or mimetypes.guess_type(upload.name)[0]
+                or ""
+            )
+        return attrs
 
-class DocumentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Document
         fields = "__all__"
+
+
+class DocumentRevisionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DocumentRevision
+        exclude = ["document", "chunks", "stored_file"]
+
+
+class FolderPermissionSerializer(serializers.ModelSerializer):
+    def validate(self, attrs):
+        if (attrs.get("user") is None) == (attrs.get("group") is None):
+            raise serializers.ValidationError(
+                "Exactly one of user and group has to be given."
+            )
+        return attrs
+
+    class Meta:
+        model = FolderPermission
+        exclude = ["folder"]
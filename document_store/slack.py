@@ -1,12 +1,27 @@
+import logging
+
 from django.conf import settings
 from rest_framework import status
 
 from slack import WebhookClient
 
+logger = logging.getLogger(__name__)
 
-def notify_slack_on_upload(document):
+
+def send_notification(message):
     client = WebhookClient(settings.SLACK_WEBHOOK_URL)
 
+    response = client.send(text=message)
+
+    if not response.status_code == status.HTTP_200_OK:
+        logger.warning(
+            "Slack notification failed with status %s: %s",
+            response.status_code,
+            response.body,
+        )
+
+
+def notify_slack_on_upload(document):
     message = (
         f"New document uploaded:\n\n"
         f"Name: {document.name}\n"
@@ -14,8 +29,16 @@ def notify_slack_on_upload(document):
         f"Topic: {document.topic}\n"
     )
 
-    response = client.send(text=message)
+    send_notification(message)
 
-    if not response.status_code == status.HTTP_200_OK:
-        # TODO: Handle error case if Slack notification fails
-        pass
+
+def notify_slack_on_import(folder, report):
+    message = (
+        f"Archive imported:\n\n"
+        f"Folder: {folder}\n"
+        f"Folders created: {report.folders_created}\n"
+        f"Documents created: {report.documents_created}\n"
+        f"Errors: {len(report.errors)}\n"
+    )
+
+    send_notification(message)
@@ -0,0 +1,232 @@
+import gzip
+import io
+import itertools
+import os
+import struct
+import zlib
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# stored files start with MAGIC, a codec byte and the original size
+MAGIC = b"\x89SDSC"
+HEADER = struct.Struct(f">{len(MAGIC)}scQ")
+GZIP = b"g"
+ZSTD = b"z"
+CONTENT_ENCODINGS = {GZIP: "gzip", ZSTD: "zstd"}
+
+# signatures of formats that are compressed already
+COMPRESSED_SIGNATURES = (
+    b"PK\x03\x04",  # zip, docx, xlsx, odt, jar, epub
+    b"\x1f\x8b",  # gzip
+    b"\x28\xb5\x2f\xfd",  # zstd
+    b"BZh",  # bzip2
+    b"\xfd7zXZ\x00",  # xz
+    b"7z\xbc\xaf\x27\x1c",  # 7z
+    b"Rar!",  # rar
+    b"\x89PNG",  # png
+    b"\xff\xd8\xff",  # jpeg
+    b"GIF8",  # gif
+    b"OggS",  # ogg
+    b"ID3",  # mp3
+    b"fLaC",  # flac
+    MAGIC,
+)
+# a trial deflate of the first chunk has to save at least this much
+MIN_SAVING = 0.1
+
+
+def is_compressible(sample):
+    if not sample or sample.startswith(COMPRESSED_SIGNATURES):
+        return False
+    # mp4/mov/heic and riff based webp/avi
+    if sample[4:8] == b"ftyp" or sample[8:12] in (b"WEBP", b"AVI "):
+        return False
+    return len(zlib.compress(sample, 1)) <= len(sample) * (1 - MIN_SAVING)
+
+
+def read_header(fileobj):
+    """Return ``(codec, original size)`` of a stored file, or ``None``."""
+    data = fileobj.read(HEADER.size)
+    if len(data) == HEADER.size and data.startswith(MAGIC):
+        _, codec, size = HEADER.unpack(data)
+        if codec in CONTENT_ENCODINGS:
+            return codec, size
+    return None
+
+
+def accepted_encodings(accept_encoding):
+    accepted = set()
+    for value in accept_encoding.split(","):
+        coding, _, params = value.partition(";")
+        if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+class ChunkedContent(File):
+    """Content whose chunks come from an already started iterator."""
+
+    def __init__(self, chunks, name=None):
+        super().__init__(None, name)
+        self._chunks = chunks
+
+    def chunks(self, chunk_size=None):
+        return self._chunks
+
+
+class DecompressedStream(io.RawIOBase):
+    """Reads the original bytes of a stored file, decompressing as it goes."""
+
+    def __init__(self, raw, codec):
+        self._raw = raw
+        if codec == ZSTD:
+            self._reader = zstandard.ZstdDecompressor().stream_reader(
+                raw, closefd=False
+            )
+        else:
+            self._reader = gzip.GzipFile(fileobj=raw, mode="rb")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._reader.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._reader.close()
+            self._raw.close()
+        super().close()
+
+
+class CompressedFileSystemStorage(FileSystemStorage):
+    """
+    File system storage that compresses compressible content at rest.
+
+    File names are unchanged: compressed files carry a small header and are
+    decompressed transparently by ``open()``. As the stored bytes are not
+    the file any more, serve them through ``open_encoded()`` rather than
+    from the storage URL. Content is compressed with zstd when
+    ``zstandard`` is installed and with gzip otherwise, both as a single
+    frame that can be handed to HTTP clients unchanged as
+    ``Content-Encoding``.
+    """
+
+    def __init__(self, *args, codec=None, level=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.codec = codec or (ZSTD if zstandard is not None else GZIP)
+        self.level = level
+
+    def compress(self, chunks, size):
+        yield HEADER.pack(MAGIC, self.codec, size)
+        if self.codec == ZSTD:
+            compressor = zstandard.ZstdCompressor(level=self.level or 3).compressobj()
+        else:
+            compressor = zlib.compressobj(self.level or 6, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    def encode(self, content):
+        """
+        Return an iterator over the bytes to store for ``content`` and
+        whether they are compressed.
+        """
+        chunks = content.chunks()
+        sample = next(chunks, b"")
+        chunks = itertools.chain([sample], chunks)
+        size = getattr(content, "size", None)
+        if size is None:
+            return chunks, False
+        # content that looks like a header is always wrapped in one, so that
+        # it is never mistaken for a compressed file
+        if not sample.startswith(MAGIC) and not is_compressible(sample):
+            return chunks, False
+        return self.compress(chunks, size), True
+
+    def _save(self, name, content):
+        chunks, compressed = self.encode(content)
+        if not compressed and hasattr(content, "temporary_file_path"):
+            # let the parent move the upload into place instead of copying
+            return super()._save(name, content)
+        return super()._save(name, ChunkedContent(chunks, name))
+
+    def _open(self, name, mode="rb"):
+        if "b" not in mode or "r" not in mode or "+" in mode:
+            return super()._open(name, mode)
+
+        raw = open(self.path(name), "rb")
+        header = read_header(raw)
+        if header is None:
+            raw.seek(0)
+            return File(raw)
+
+        codec, size = header
+        stored = File(io.BufferedReader(DecompressedStream(raw, codec)), name)
+        stored.size = size
+        return stored
+
+    def open_encoded(self, name, accept_encoding=""):
+        """
+        Open ``name`` for sending over HTTP. Compressed bytes are returned
+        as stored when their encoding is listed in ``accept_encoding``.
+
+        Returns ``(file, content encoding or None, length)``.
+        """
+        raw = open(self.path(name), "rb")
+        header = read_header(raw)
+        if header is None:
+            raw.seek(0)
+            return raw, None, os.fstat(raw.fileno()).st_size
+
+        codec, size = header
+        encoding = CONTENT_ENCODINGS[codec]
+        if encoding in accepted_encodings(accept_encoding):
+            return raw, encoding, os.fstat(raw.fileno()).st_size - HEADER.size
+        return io.BufferedReader(DecompressedStream(raw, codec)), None, size
+
+    def size(self, name):
+        with open(self.path(name), "rb") as raw:
+            header = read_header(raw)
+        if header is None:
+            return super().size(name)
+        return header[1]
+
+    def compress_existing(self, name):
+        """
+        Compress a file that was stored before compression was enabled.
+
+        Returns the ``(old, new)`` size on disk, or ``None`` when the file
+        is already compressed or would not get smaller.
+        """
+        path = self.path(name)
+        with open(path, "rb") as raw:
+            if read_header(raw) is not None:
+                return None
+            raw.seek(0)
+            chunks, compressed = self.encode(File(raw, name))
+            if not compressed:
+                return None
+
+            temporary_path = f"{path}.compressing"
+            with open(temporary_path, "wb") as target:
+                for chunk in chunks:
+                    target.write(chunk)
+
+        old_size = os.path.getsize(path)
+        new_size = os.path.getsize(temporary_path)
+        if new_size >= old_size:
+            os.remove(temporary_path)
+            return None
+        os.replace(temporary_path, path)
+        return old_size, new_size
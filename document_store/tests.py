@@ -1,16 +1,41 @@
-from django.contrib.auth.models import User
+import gzip
+import json
+import os
+import random
+import tarfile
+import tempfile
+import zipfile
+from io import BytesIO, StringIO
+from unittest import mock
+
+from django.contrib.auth.models import Group, User
 from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APIClient
 
+from .access import access_scope
 from .cache_manager import CacheKeys
-from .models import Document, Folder, Topic
+from .importer import import_archive
+from .models import Chunk, Document, Folder, FolderPermission, Topic
 from .pagination import StandardPagination
+from .revisions import (
+    MAX_CHUNK_SIZE,
+    chunk_digest,
+    chunk_pending_revisions,
+    iter_chunk_content,
+    iter_chunks,
+)
 from .serializers import DocumentSerializer, FolderSerializer, TopicSerializer
+from .slack import notify_slack_on_import
+from .storage import GZIP, MAGIC
 
 
 class TopicViewSetTestCase(TestCase):
@@ -177,6 +202,7 @@ class FolderViewSetTestCase(TestCase):
         self.assertNotEqual(response1.data, response2.data)
 
 
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
 class DocumentViewSetTestCase(TestCase):
     def setUp(self):
         self.client = APIClient()
@@ -213,6 +239,18 @@ class DocumentViewSetTestCase(TestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertEqual(Document.objects.count(), 3)
 
+    @mock.patch("document_store.views.notify_slack_on_upload")
+    def test_create_document_records_size_and_content_type(self, notify):
+        url = reverse("document-list")
+        response = self.client.post(url, data=self.valid_payload)
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["size"], len(b"file_content"))
+        self.assertEqual(response.data["content_type"], "text/plain")
+        self.folder.refresh_from_db()
+        self.assertEqual(self.folder.document_count, 3)
+        self.assertEqual(self.folder.total_size, len(b"file_content"))
+
     def test_create_document_with_invalid_payload(self):
         url = reverse("document-list")
         response = self.client.post(url, data=self.invalid_payload)
@@ -292,3 +330,1061 @@ class DocumentViewSetTestCase(TestCase):
         )
 
         self.assertNotEqual(response1.data, response2.data)
+
+
+class FolderAggregatesTestCase(TestCase):
+    def setUp(self):
+        self.root = Folder.objects.create(name="Root")
+        self.child = Folder.objects.create(name="Child", parent=self.root)
+        self.other = Folder.objects.create(name="Other")
+
+    def tearDown(self):
+        cache.clear()
+
+    def assertAggregates(self, folder, direct, subtree):
+        folder.refresh_from_db()
+        self.assertEqual((folder.document_count, folder.total_size), direct)
+        self.assertEqual((folder.subtree_document_count, folder.subtree_size), subtree)
+
+    def test_tree_path(self):
+        self.assertEqual(self.child.tree_path, f"{self.root.pk}/{self.child.pk}/")
+
+    def test_document_create_and_delete(self):
+        document = Document.objects.create(name="Doc", folder=self.child, size=10)
+        self.assertAggregates(self.child, (1, 10), (1, 10))
+        self.assertAggregates(self.root, (0, 0), (1, 10))
+        self.assertIsNotNone(self.root.subtree_last_modified)
+
+        document.delete()
+        self.assertAggregates(self.child, (0, 0), (0, 0))
+        self.assertAggregates(self.root, (0, 0), (0, 0))
+
+    def test_document_move(self):
+        document = Document.objects.create(name="Doc", folder=self.child, size=10)
+        document.folder = self.other
+        document.save()
+
+        self.assertAggregates(self.root, (0, 0), (0, 0))
+        self.assertAggregates(self.other, (1, 10), (1, 10))
+
+    def test_folder_move(self):
+        Document.objects.create(name="Doc", folder=self.child, size=10)
+        self.child.parent = self.other
+        self.child.save()
+
+        self.assertEqual(self.child.tree_path, f"{self.other.pk}/{self.child.pk}/")
+        self.assertAggregates(self.root, (0, 0), (0, 0))
+        self.assertAggregates(self.other, (0, 0), (1, 10))
+
+    def test_folder_delete(self):
+        Document.objects.create(name="Doc", folder=self.child, size=10)
+        self.child.delete()
+
+        self.assertAggregates(self.root, (0, 0), (0, 0))
+
+    def test_folder_delete_does_not_touch_each_document(self):
+        Document.objects.create(name="Kept", folder=self.root, size=1)
+
+        def delete_subtree(documents):
+            child = Folder.objects.create(name="Child", parent=self.root)
+            grandchild = Folder.objects.create(name="Grandchild", parent=child)
+            for index in range(documents):
+                Document.objects.create(name=f"Doc {index}", folder=child, size=10)
+                Document.objects.create(name=f"Doc {index}", folder=grandchild, size=5)
+            with CaptureQueriesContext(connection) as queries:
+                child.delete()
+            self.assertAggregates(self.root, (1, 1), (1, 1))
+            return len(queries)
+
+        self.assertEqual(delete_subtree(2), delete_subtree(50))
+
+    def test_folder_queryset_delete(self):
+        grandchild = Folder.objects.create(name="Grandchild", parent=self.child)
+        Document.objects.create(name="Doc", folder=self.child, size=10)
+        Document.objects.create(name="Doc", folder=grandchild, size=5)
+
+        Folder.objects.filter(pk__in=[self.child.pk, grandchild.pk]).delete()
+
+        self.assertAggregates(self.root, (0, 0), (0, 0))
+
+    def test_reconcile_repairs_drift(self):
+        Document.objects.create(name="Doc", folder=self.child, size=10)
+        Folder.objects.update(subtree_document_count=0, subtree_size=0, tree_path="")
+
+        call_command("reconcile_folder_aggregates", stdout=StringIO())
+
+        self.assertAggregates(self.root, (0, 0), (1, 10))
+        self.assertEqual(self.child.tree_path, f"{self.root.pk}/{self.child.pk}/")
+
+    def test_folder_serializer_exposes_aggregates(self):
+        Document.objects.create(name="Doc", folder=self.child, size=10)
+        self.root.refresh_from_db()
+        data = FolderSerializer(self.root).data
+
+        self.assertEqual(data["subtree_document_count"], 1)
+        self.assertEqual(data["subtree_size"], 10)
+
+
+class ShapedResponseTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username="test_user", password="test_password"
+        )
+        self.client.force_authenticate(user=self.user)
+
+        self.topic = Topic.objects.create(name="Topic")
+        self.root = Folder.objects.create(name="finance")
+        self.folder = Folder.objects.create(name="2024", parent=self.root)
+        for index in range(5):
+            Document.objects.create(
+                name=f"Document {index}", folder=self.folder, topic=self.topic
+            )
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_fields_selects_columns(self):
+        response = self.client.get(reverse("document-list"), {"fields": "id,name"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(response.data["results"][0]), {"id", "name"})
+
+    def test_expand_folder_path_and_topic(self):
+        response = self.client.get(
+            reverse("document-list"), {"expand": "folder.path,topic"}
+        )
+
+        document = response.data["results"][0]
+        self.assertEqual(document["folder"]["path"], "finance/2024")
+        self.assertNotIn("children", document["folder"])
+        self.assertEqual(document["topic"], {"id": self.topic.pk, "name": "Topic"})
+
+    def test_expand_uses_constant_queries(self):
+        url = reverse("document-list")
+        params = {"expand": "folder.path,topic"}
+        # folder grants, count, page, folder names
+        with self.assertNumQueries(4):
+            self.client.get(url, params)
+
+        for index in range(5):
+            Document.objects.create(name=f"Extra {index}", folder=self.root)
+        cache.clear()
+        with self.assertNumQueries(4):
+            self.client.get(url, params)
+
+    def test_folder_children_are_prefetched(self):
+        # folder grants, count, page, child folders, documents, folder names
+        with self.assertNumQueries(6):
+            self.client.get(reverse("folder-list"), {"expand": "parent.path"})
+
+        # count, page, the grants are cached
+        with self.assertNumQueries(2):
+            self.client.get(reverse("folder-list"), {"fields": "id,name"})
+
+    def test_unknown_expansion_is_rejected(self):
+        response = self.client.get(reverse("document-list"), {"expand": "owner"})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_cache_is_keyed_by_shape(self):
+        url = reverse("document-detail", args=[Document.objects.first().pk])
+        narrow = self.client.get(url, {"fields": "name"})
+        full = self.client.get(url)
+
+        self.assertEqual(set(narrow.data), {"name"})
+        self.assertIn("folder", full.data)
+
+    def test_shaped_cache_is_invalidated(self):
+        url = reverse("folder-detail", args=[self.folder.pk])
+        self.client.get(url, {"expand": "path"})
+
+        self.root.name = "accounting"
+        self.root.save()
+        response = self.client.get(url, {"expand": "path"})
+
+        self.assertEqual(response.data["path"], "accounting/2024")
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class FolderArchiveTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username="test_user", password="test_password"
+        )
+        self.client.force_authenticate(user=self.user)
+
+        self.root = Folder.objects.create(name="finance")
+        self.child = Folder.objects.create(name="2024", parent=self.root)
+        Folder.objects.create(name="empty", parent=self.root)
+        Document.objects.create(
+            name="report.csv",
+            folder=self.child,
+            file=SimpleUploadedFile("report.csv", b"a,b\n" * 100),
+        )
+        Document.objects.create(
+            name="scan.png",
+            folder=self.root,
+            file=SimpleUploadedFile("scan.png", b"\x89PNG" + b"\x00" * 100),
+        )
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_archive_streams_folder_subtree(self):
+        url = reverse("folder-archive", args=[self.root.pk])
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "application/zip")
+
+        content = b"".join(response.streaming_content)
+        with zipfile.ZipFile(BytesIO(content)) as archive:
+            self.assertEqual(
+                sorted(archive.namelist()),
+                [
+                    "finance/",
+                    "finance/2024/",
+                    "finance/2024/report.csv",
+                    "finance/empty/",
+                    "finance/scan.png",
+                ],
+            )
+            self.assertEqual(archive.read("finance/2024/report.csv"), b"a,b\n" * 100)
+            self.assertEqual(
+                archive.getinfo("finance/2024/report.csv").compress_type,
+                zipfile.ZIP_DEFLATED,
+            )
+            self.assertEqual(
+                archive.getinfo("finance/scan.png").compress_type, zipfile.ZIP_STORED
+            )
+
+    def test_archive_query_does_not_grow_with_folders(self):
+        url = reverse("folder-archive", args=[self.root.pk])
+
+        def document_queries():
+            with CaptureQueriesContext(connection) as queries:
+                b"".join(self.client.get(url).streaming_content)
+            return [
+                query["sql"]
+                for query in queries
+                if 'FROM "document_store_document"' in query["sql"]
+            ]
+
+        before = document_queries()
+        for index in range(20):
+            Folder.objects.create(name=f"extra {index}", parent=self.root)
+        self.assertEqual(document_queries(), before)
+
+    def test_archive_file_name_is_quoted(self):
+        self.root.name = 'Q3 "final" Überblick'
+        self.root.save()
+        url = reverse("folder-archive", args=[self.root.pk])
+        response = self.client.get(url)
+
+        self.assertEqual(
+            response["Content-Disposition"],
+            "attachment; filename*=utf-8''Q3%20%22final%22%20%C3%9Cberblick.zip",
+        )
+
+    def test_archive_of_sub_folder_starts_at_that_folder(self):
+        url = reverse("folder-archive", args=[self.child.pk])
+        content = b"".join(self.client.get(url).streaming_content)
+
+        with zipfile.ZipFile(BytesIO(content)) as archive:
+            self.assertEqual(archive.namelist(), ["2024/", "2024/report.csv"])
+
+    def test_archive_leaves_out_folders_below_hidden_ones(self):
+        other = User.objects.create_user(username="other_user")
+        hr = Folder.objects.create(name="hr", parent=self.root)
+        payroll = Folder.objects.create(name="payroll", parent=hr)
+        Document.objects.create(
+            name="salaries.csv",
+            folder=payroll,
+            file=SimpleUploadedFile("salaries.csv", b"a,b\n"),
+        )
+        FolderPermission.objects.create(folder=hr, user=other)
+        FolderPermission.objects.create(folder=payroll, user=self.user)
+
+        url = reverse("folder-archive", args=[self.root.pk])
+        content = b"".join(self.client.get(url).streaming_content)
+
+        with zipfile.ZipFile(BytesIO(content)) as archive:
+            names = archive.namelist()
+        self.assertIn("finance/2024/report.csv", names)
+        self.assertFalse([name for name in names if "hr" in name.split("/")])
+        self.assertNotIn("salaries.csv", "".join(names))
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class ArchiveImportTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username="test_user", password="test_password"
+        )
+        self.client.force_authenticate(user=self.user)
+
+        self.root = Folder.objects.create(name="share")
+        self.existing = Folder.objects.create(name="docs", parent=self.root)
+
+    def tearDown(self):
+        cache.clear()
+
+    def build_zip(self):
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, "w") as archive:
+            archive.writestr("docs/readme.txt", b"hello")
+            archive.writestr("docs/2024/q3/report.csv", b"a,b\n1,2\n")
+            archive.writestr("../escape.txt", b"nope")
+        buffer.seek(0)
+        return buffer
+
+    @mock.patch("document_store.views.notify_slack_on_import")
+    def test_import_zip_endpoint(self, notify):
+        url = reverse("folder-import-archive", args=[self.root.pk])
+        upload = SimpleUploadedFile("share.zip", self.build_zip().read())
+        response = self.client.post(url, {"archive": upload})
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["documents_created"], 2)
+        self.assertEqual(response.data["folders_created"], 2)
+        self.assertEqual(response.data["errors"][0]["entry"], "../escape.txt")
+        notify.assert_called_once()
+
+        report = Document.objects.get(name="report.csv")
+        self.assertEqual(str(report.folder), "share/docs/2024/q3")
+        self.assertEqual(report.file.read(), b"a,b\n1,2\n")
+        self.assertEqual(report.content_type, "text/csv")
+        self.assertEqual(
+            Document.objects.get(name="readme.txt").folder_id, self.existing.pk
+        )
+
+        self.root.refresh_from_db()
+        self.assertEqual(self.root.subtree_document_count, 2)
+        self.assertEqual(self.root.subtree_size, 5 + 8)
+        q3 = report.folder
+        self.assertEqual(q3.tree_path, f"{q3.parent.tree_path}{q3.pk}/")
+
+    @mock.patch("document_store.views.notify_slack_on_import")
+    def test_import_skips_folders_without_write_access(self, notify):
+        secret = Folder.objects.create(name="secret", parent=self.root)
+        FolderPermission.objects.create(
+            folder=secret,
+            user=User.objects.create_user(username="other_user"),
+            access=FolderPermission.WRITE,
+        )
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, "w") as archive:
+            archive.writestr("secret/planted.txt", b"planted")
+            archive.writestr("secret/deeper/planted.txt", b"planted")
+            archive.writestr("docs/readme.txt", b"hello")
+        url = reverse("folder-import-archive", args=[self.root.pk])
+        upload = SimpleUploadedFile("share.zip", buffer.getvalue())
+        response = self.client.post(url, {"archive": upload})
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["documents_created"], 1)
+        self.assertEqual(response.data["folders_created"], 0)
+        self.assertEqual(
+            sorted(error["entry"] for error in response.data["errors"]),
+            ["secret/deeper/planted.txt", "secret/planted.txt"],
+        )
+        self.assertFalse(Document.objects.filter(name="planted.txt").exists())
+        self.assertFalse(Folder.objects.filter(name="deeper").exists())
+
+    def test_import_fits_file_names_into_the_file_field(self):
+        long_name = "x" * 150 + ".txt"
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, "w") as archive:
+            archive.writestr(long_name, b"long")
+            archive.writestr("notes." + "y" * 120, b"unfit")
+            archive.writestr("short.txt", b"short")
+        buffer.seek(0)
+
+        report = import_archive(buffer, self.root)
+
+        self.assertEqual(report.documents_created, 2)
+        self.assertEqual(
+            [error["entry"] for error in report.errors], ["notes." + "y" * 120]
+        )
+        document = Document.objects.get(name=long_name)
+        self.assertLessEqual(len(document.file.name), 100)
+        self.assertEqual(document.file.read(), b"long")
+
+    @mock.patch("document_store.importer.BATCH_SIZE", 1)
+    def test_import_counts_every_inserted_batch(self):
+        bulk_create = Document.objects.bulk_create
+        calls = []
+
+        def fail_second_batch(*args, **kwargs):
+            calls.append(args)
+            if len(calls) > 1:
+                raise RuntimeError("disk full")
+            return bulk_create(*args, **kwargs)
+
+        with mock.patch.object(
+            Document.objects, "bulk_create", side_effect=fail_second_batch
+        ):
+            with self.assertRaises(RuntimeError):
+                import_archive(self.build_zip(), self.root)
+
+        self.root.refresh_from_db()
+        self.assertEqual(Document.objects.count(), 1)
+        self.assertEqual(self.root.subtree_document_count, 1)
+
+    def test_import_of_empty_folders_refreshes_the_parent(self):
+        url = reverse("folder-detail", args=[self.existing.pk])
+        self.assertEqual(self.client.get(url).data["children"], [])
+
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, "w") as archive:
+            archive.writestr("docs/empty/", b"")
+        buffer.seek(0)
+        import_archive(buffer, self.root)
+
+        self.assertEqual(
+            self.client.get(url).data["children"],
+            [{"name": "empty", "type": "folder"}],
+        )
+
+    @mock.patch("document_store.slack.WebhookClient")
+    def test_failed_import_notification_is_logged(self, client):
+        client.return_value.send.return_value = mock.Mock(
+            status_code=500, body="invalid_token"
+        )
+        report = import_archive(self.build_zip(), self.root)
+
+        with self.assertLogs("document_store.slack", "WARNING") as logs:
+            notify_slack_on_import(self.root, report)
+
+        self.assertIn("invalid_token", logs.output[0])
+
+    @mock.patch("document_store.views.notify_slack_on_import")
+    def test_import_rejects_non_archive(self, notify):
+        url = reverse("folder-import-archive", args=[self.root.pk])
+        upload = SimpleUploadedFile("notes.txt", b"not an archive")
+        response = self.client.post(url, {"archive": upload})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        notify.assert_not_called()
+
+    def test_import_tar_command(self):
+        path = os.path.join(tempfile.mkdtemp(), "share.tar.gz")
+        with tarfile.open(path, "w:gz") as archive:
+            data = b"tar content"
+            info = tarfile.TarInfo("notes/todo.txt")
+            info.size = len(data)
+            archive.addfile(info, BytesIO(data))
+
+        call_command(
+            "import_archive",
+            path,
+            folder=self.root.pk,
+            no_notify=True,
+            stdout=StringIO(),
+        )
+
+        document = Document.objects.get(name="todo.txt")
+        self.assertEqual(str(document.folder), "share/notes")
+        self.assertEqual(document.size, len(b"tar content"))
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class CompressedStorageTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username="test_user", password="test_password"
+        )
+        self.client.force_authenticate(user=self.user)
+
+        # pin the codec so the results don't depend on zstandard being installed
+        codec = mock.patch.object(Document.file.field.storage, "codec", GZIP)
+        codec.start()
+        self.addCleanup(codec.stop)
+
+        self.text = b"date,amount\n" + b"2024-01-01,100\n" * 1000
+        self.folder = Folder.objects.create(name="Folder")
+        self.document = Document.objects.create(
+            name="ledger.csv",
+            folder=self.folder,
+            content_type="text/csv",
+            file=SimpleUploadedFile("ledger.csv", self.text),
+        )
+        self.storage = self.document.file.storage
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_compressible_content_is_compressed_transparently(self):
+        path = self.storage.path(self.document.file.name)
+        self.assertLess(os.path.getsize(path), len(self.text) // 3)
+        self.assertEqual(self.document.file.size, len(self.text))
+
+        document = Document.objects.get(pk=self.document.pk)
+        with document.file.open("rb") as stored:
+            self.assertEqual(stored.read(), self.text)
+
+    def test_incompressible_content_is_stored_as_is(self):
+        data = os.urandom(4096)
+        name = self.storage.save("static/upload/random.bin", ContentFile(data))
+
+        with open(self.storage.path(name), "rb") as stored:
+            self.assertEqual(stored.read(), data)
+
+    def test_download_passes_compressed_bytes_through(self):
+        url = reverse("document-download", args=[self.document.pk])
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip, deflate")
+
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        content = b"".join(response.streaming_content)
+        self.assertEqual(int(response["Content-Length"]), len(content))
+        self.assertEqual(gzip.decompress(content), self.text)
+
+    def test_download_stays_compressed_after_chunking(self):
+        self.document.file = SimpleUploadedFile("ledger.csv", self.text * 2)
+        self.document.size = len(self.text) * 2
+        self.document.save()
+        call_command("chunk_revisions", stdout=StringIO())
+
+        url = reverse("document-download", args=[self.document.pk])
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip")
+
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        content = gzip.decompress(b"".join(response.streaming_content))
+        self.assertEqual(content, self.text * 2)
+
+    def test_content_that_looks_compressed_is_kept(self):
+        data = MAGIC + os.urandom(64)
+        name = self.storage.save("static/upload/tricky.bin", ContentFile(data))
+
+        with self.storage.open(name) as stored:
+            self.assertEqual(stored.read(), data)
+
+    def test_file_links_to_the_download_endpoint(self):
+        response = self.client.get(reverse("document-detail", args=[self.document.pk]))
+
+        url = reverse("document-download", args=[self.document.pk])
+        self.assertEqual(response.data["file"], f"http://testserver{url}")
+
+    def test_download_decompresses_for_other_clients(self):
+        url = reverse("document-download", args=[self.document.pk])
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip;q=0")
+
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(int(response["Content-Length"]), len(self.text))
+        self.assertEqual(b"".join(response.streaming_content), self.text)
+
+    def test_compress_documents_command(self):
+        name = "static/upload/legacy.txt"
+        path = self.storage.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as legacy:
+            legacy.write(self.text)
+        Document.objects.create(name="legacy.txt", folder=self.folder, file=name)
+
+        call_command("compress_documents", stdout=StringIO())
+
+        self.assertLess(os.path.getsize(path), len(self.text) // 3)
+        with self.storage.open(name) as stored:
+            self.assertEqual(stored.read(), self.text)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class DocumentRevisionTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username="test_user", password="test_password"
+        )
+        self.client.force_authenticate(user=self.user)
+
+        self.content = random.Random(0).randbytes(200 * 1024)
+        self.folder = Folder.objects.create(name="Folder")
+        self.document = Document.objects.create(
+            name="data.bin",
+            folder=self.folder,
+            size=len(self.content),
+            file=SimpleUploadedFile("data.bin", self.content),
+        )
+
+    def tearDown(self):
+        cache.clear()
+
+    def edit(self, content):
+        return content[:100_000] + b"small edit" + content[100_000:]
+
+    def test_edit_only_changes_nearby_chunks(self):
+        before = list(iter_chunks(BytesIO(self.content)))
+        after = list(iter_chunks(BytesIO(self.edit(self.content))))
+
+        self.assertEqual(b"".join(after), self.edit(self.content))
+        self.assertLessEqual(len(set(after) - set(before)), 2)
+
+    def replace_file(self, content):
+        self.document.file = SimpleUploadedFile("data.bin", content)
+        self.document.size = len(content)
+        self.document.save()
+
+    def test_update_records_revision_and_shares_chunks(self):
+        old_file = self.document.file.name
+        url = reverse("document-revisions", args=[self.document.pk])
+        upload = SimpleUploadedFile("data.bin", self.edit(self.content))
+        response = self.client.post(url, {"file": upload})
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["number"], 2)
+        self.assertEqual(chunk_pending_revisions(), 1)
+        self.assertFalse(self.document.file.storage.exists(old_file))
+        chunks_before = Chunk.objects.count()
+
+        self.replace_file(b"replaced")
+        self.assertEqual(chunk_pending_revisions(), 1)
+        self.assertLessEqual(Chunk.objects.count() - chunks_before, 2)
+
+        first, second = self.document.revisions.filter(number__lte=2)
+        self.assertTrue(set(first.chunks) & set(second.chunks))
+
+    def test_heads_are_stored_once(self):
+        head = self.document.file.name
+        self.assertEqual(chunk_pending_revisions(), 0)
+        self.assertEqual(Chunk.objects.count(), 0)
+
+        self.replace_file(b"replaced")
+        revision = self.document.revisions.get(number=1)
+        self.assertEqual(revision.stored_file, head)
+
+        call_command("chunk_revisions", stdout=StringIO())
+        revision.refresh_from_db()
+        self.assertEqual(revision.stored_file, "")
+        self.assertFalse(self.document.file.storage.exists(head))
+        self.assertEqual(
+            b"".join(iter_chunk_content(revision.chunks, self.document.file.storage)),
+            self.content,
+        )
+        self.assertEqual(self.document.revisions.get(number=2).chunks, [])
+
+    def test_superseded_file_waits_for_its_revision(self):
+        self.replace_file(b"first")
+        pending = self.document.revisions.get(number=2).stored_file
+
+        self.replace_file(b"second")
+        self.assertTrue(self.document.file.storage.exists(pending))
+
+        response = self.client.post(
+            reverse("document-restore", args=[self.document.pk, 2])
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        call_command("chunk_revisions", stdout=StringIO())
+
+        self.assertFalse(self.document.file.storage.exists(pending))
+        with Document.objects.get(pk=self.document.pk).file.open("rb") as stored:
+            self.assertEqual(stored.read(), b"first")
+
+    def test_list_revisions(self):
+        response = self.client.get(
+            reverse("document-revisions", args=[self.document.pk])
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["results"][0]["number"], 1)
+        self.assertNotIn("chunks", response.data["results"][0])
+        self.assertNotIn("stored_file", response.data["results"][0])
+
+    def test_restore_revision(self):
+        self.replace_file(b"replaced")
+        chunk_pending_revisions()
+
+        url = reverse("document-restore", args=[self.document.pk, 1])
+        response = self.client.post(url)
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["number"], 3)
+        document = Document.objects.get(pk=self.document.pk)
+        self.assertEqual(document.size, len(self.content))
+        with document.file.open("rb") as stored:
+            self.assertEqual(stored.read(), self.content)
+
+    def test_manifest_upload_rejects_oversized_chunks(self):
+        data = os.urandom(MAX_CHUNK_SIZE + 1)
+        digest = chunk_digest(data)
+        url = reverse("document-revisions", args=[self.document.pk])
+        response = self.client.post(
+            url,
+            {
+                "manifest": json.dumps([digest]),
+                digest: SimpleUploadedFile(digest, data),
+            },
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn(digest, response.data)
+        self.assertFalse(Chunk.objects.filter(digest=digest).exists())
+
+    def test_manifest_upload_only_needs_missing_chunks(self):
+        self.replace_file(b"replaced")
+        chunk_pending_revisions()
+        edited = self.edit(self.content)
+        chunks = {chunk_digest(data): data for data in iter_chunks(BytesIO(edited))}
+        manifest = [chunk_digest(data) for data in iter_chunks(BytesIO(edited))]
+        url = reverse("document-revisions", args=[self.document.pk])
+
+        response = self.client.post(url, {"manifest": json.dumps(manifest)})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        missing = response.data["missing"]
+        self.assertLessEqual(len(missing), 2)
+
+        payload = {"manifest": json.dumps(manifest), "file_name": "data.bin"}
+        for digest in missing:
+            payload[digest] = SimpleUploadedFile(digest, chunks[digest])
+        response = self.client.post(url, payload)
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        document = Document.objects.get(pk=self.document.pk)
+        self.assertEqual(document.size, len(edited))
+        with document.file.open("rb") as stored:
+            self.assertEqual(stored.read(), edited)
+
+
+class FolderPermissionTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username="test_user", password="test_password"
+        )
+        self.other = User.objects.create_user(
+            username="other_user", password="test_password"
+        )
+        self.client.force_authenticate(user=self.user)
+
+        self.public = Folder.objects.create(name="public")
+        self.hr = Folder.objects.create(name="hr")
+        self.payroll = Folder.objects.create(name="payroll", parent=self.hr)
+        self.document = Document.objects.create(name="salaries", folder=self.payroll)
+        FolderPermission.objects.create(folder=self.hr, user=self.other)
+
+    def tearDown(self):
+        cache.clear()
+
+    def folder_names(self):
+        response = self.client.get(reverse("folder-list"))
+        return {folder["name"] for folder in response.data["results"]}
+
+    def test_restriction_is_inherited(self):
+        self.payroll.refresh_from_db()
+        self.assertTrue(self.payroll.restricted)
+
+        child = Folder.objects.create(name="2024", parent=self.payroll)
+        child.refresh_from_db()
+        self.assertTrue(child.restricted)
+        self.public.refresh_from_db()
+        self.assertFalse(self.public.restricted)
+
+    def test_restricted_folders_are_hidden(self):
+        self.assertEqual(self.folder_names(), {"public"})
+
+        response = self.client.get(reverse("document-list"))
+        self.assertEqual(response.data["count"], 0)
+        response = self.client.get(reverse("folder-detail", args=[self.payroll.pk]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_user_and_group_grants(self):
+        FolderPermission.objects.create(folder=self.payroll, user=self.user)
+        self.assertEqual(self.folder_names(), {"public", "payroll"})
+
+        group = Group.objects.create(name="hr")
+        FolderPermission.objects.create(folder=self.hr, group=group)
+        self.user.groups.add(group)
+        self.assertEqual(self.folder_names(), {"public", "hr", "payroll"})
+        response = self.client.get(reverse("document-list"))
+        self.assertEqual(response.data["count"], 1)
+
+    def test_cached_responses_are_not_shared(self):
+        self.client.force_authenticate(user=self.other)
+        self.assertEqual(self.folder_names(), {"public", "hr", "payroll"})
+
+        self.client.force_authenticate(user=self.user)
+        self.assertEqual(self.folder_names(), {"public"})
+
+    def test_removing_the_last_entry_opens_the_folder(self):
+        FolderPermission.objects.filter(folder=self.hr).delete()
+
+        self.assertEqual(self.folder_names(), {"public", "hr", "payroll"})
+
+    def test_moving_into_a_restricted_folder(self):
+        self.client.force_authenticate(user=self.other)
+        self.public.parent = self.hr
+        self.public.save()
+
+        self.client.force_authenticate(user=self.user)
+        self.assertEqual(self.folder_names(), set())
+
+    def test_write_requires_write_access(self):
+        FolderPermission.objects.create(folder=self.hr, user=self.user)
+
+        response = self.client.post(
+            reverse("folder-list"), {"name": "2025", "parent": self.payroll.pk}
+        )
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.delete(
+            reverse("document-detail", args=[self.document.pk])
+        )
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        FolderPermission.objects.create(
+            folder=self.payroll, user=self.user, access=FolderPermission.WRITE
+        )
+        response = self.client.post(
+            reverse("folder-list"), {"name": "2025", "parent": self.payroll.pk}
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_aggregates_leave_out_hidden_folders(self):
+        hidden = Folder.objects.create(name="2024", parent=self.public)
+        FolderPermission.objects.create(folder=hidden, user=self.other)
+        Document.objects.create(name="notes", folder=self.public, size=10)
+        for index in range(5):
+            Document.objects.create(name=f"report {index}", folder=hidden, size=100)
+
+        url = reverse("folder-detail", args=[self.public.pk])
+        response = self.client.get(url)
+        self.assertEqual(
+            response.data["children"], [{"name": "notes", "type": "document"}]
+        )
+        self.assertEqual(response.data["subtree_document_count"], 1)
+        self.assertEqual(response.data["subtree_size"], 10)
+        response = self.client.get(reverse("folder-list"), {"fields": "subtree_size"})
+        self.assertEqual(response.data["results"], [{"subtree_size": 10}])
+        response = self.client.get(reverse("document-list"), {"expand": "folder"})
+        self.assertEqual(response.data["results"][0]["folder"]["subtree_size"], 10)
+
+        self.client.force_authenticate(user=self.other)
+        response = self.client.get(url)
+        self.assertEqual(response.data["subtree_document_count"], 6)
+        self.assertEqual(response.data["subtree_size"], 510)
+
+    def test_queries_do_not_grow_with_entries(self):
+        for index in range(20):
+            folder = Folder.objects.create(name=f"team {index}")
+            FolderPermission.objects.create(folder=folder, user=self.user)
+        cache.clear()
+
+        # folder grants, count, page, child folders, documents
+        with self.assertNumQueries(5):
+            self.client.get(reverse("folder-list"))
+
+    def test_admins_manage_entries(self):
+        url = reverse("folder-acl", args=[self.public.pk])
+        response = self.client.post(url, {"user": self.other.pk})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.post(url, {"user": self.other.pk, "access": "write"})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.folder_names(), set())
+
+        response = self.client.post(url, {})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        entry = self.public.permissions.get()
+        response = self.client.delete(
+            reverse("folder-remove-acl", args=[self.hr.pk, entry.pk])
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.delete(
+            reverse("folder-remove-acl", args=[self.public.pk, entry.pk])
+        )
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.folder_names(), {"public"})
+
+
+class DocumentFacetsTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username="test_user", password="test_password"
+        )
+        self.client.force_authenticate(user=self.user)
+
+        self.reports = Topic.objects.create(name="Reports")
+        self.notes = Topic.objects.create(name="Notes")
+        self.finance = Folder.objects.create(name="finance")
+        self.hr = Folder.objects.create(name="hr")
+        for index in range(3):
+            Document.objects.create(
+                name=f"Report {index}",
+                folder=self.finance,
+                topic=self.reports,
+                content_type="application/pdf",
+            )
+        Document.objects.create(
+            name="Note", folder=self.hr, topic=self.notes, content_type="text/plain"
+        )
+        Document.objects.create(name="Loose", folder=self.hr)
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_facet_counts(self):
+        response = self.client.get(
+            reverse("document-list"), {"facets": "topic,folder,content_type"}
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        facets = response.data["facets"]
+        self.assertEqual(
+            facets["topic"],
+            [
+                {"value": self.reports.pk, "label": "Reports", "count": 3},
+                {"value": self.notes.pk, "label": "Notes", "count": 1},
+                {"value": None, "label": None, "count": 1},
+            ],
+        )
+        self.assertEqual(
+            [(row["label"], row["count"]) for row in facets["folder"]],
+            [("finance", 3), ("hr", 2)],
+        )
+        self.assertEqual(
+            [(row["value"], row["count"]) for row in facets["content_type"]],
+            [("application/pdf", 3), ("", 1), ("text/plain", 1)],
+        )
+
+    def test_facets_follow_filters(self):
+        response = self.client.get(
+            reverse("document-list"), {"topic": "Notes", "facets": "folder"}
+        )
+
+        self.assertEqual(response.data["count"], 1)
+        self.assertEqual(
+            response.data["facets"],
+            {"folder": [{"value": self.hr.pk, "label": "hr", "count": 1}]},
+        )
+
+    def test_facets_are_cached_until_documents_change(self):
+        url = reverse("document-list")
+        params = {"facets": "topic,folder"}
+        self.client.get(url, params)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, params)
+        self.assertEqual(response.data["facets"]["folder"][1]["count"], 2)
+
+        Document.objects.create(name="Extra", folder=self.hr)
+        response = self.client.get(url, params)
+        self.assertEqual(response.data["facets"]["folder"][0]["count"], 3)
+
+    def test_filters_and_pages_are_cached_separately(self):
+        url = reverse("document-list")
+        self.client.get(url)
+
+        response = self.client.get(url, {"topic": "Notes"})
+        self.assertEqual(response.data["count"], 1)
+        response = self.client.get(url, {"page": 1, "page_size": 2})
+        self.assertEqual(len(response.data["results"]), 2)
+
+    def test_unknown_facet_is_rejected(self):
+        response = self.client.get(reverse("document-list"), {"facets": "size"})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("facets", response.data)
+
+
+class PathResolutionTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username="test_user", password="test_password"
+        )
+        self.client.force_authenticate(user=self.user)
+
+        self.finance = Folder.objects.create(name="finance")
+        self.year = Folder.objects.create(name="2024", parent=self.finance)
+        self.quarter = Folder.objects.create(name="q3", parent=self.year)
+        self.report = Document.objects.create(name="report.pdf", folder=self.quarter)
+
+    def tearDown(self):
+        cache.clear()
+
+    def resolve(self, path):
+        return self.client.get(reverse("resolve"), {"path": path})
+
+    def test_resolve_folder_and_document(self):
+        response = self.resolve("finance/2024/q3")
+        self.assertEqual(
+            response.data,
+            {"path": "finance/2024/q3", "type": "folder", "id": self.quarter.pk},
+        )
+
+        response = self.resolve("/finance/2024/q3/report.pdf")
+        self.assertEqual(response.data["type"], "document")
+        self.assertEqual(response.data["id"], self.report.pk)
+
+        response = self.resolve("finance/2023")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_name_paths_follow_renames_and_moves(self):
+        self.finance.name = "accounting"
+        self.finance.save()
+        self.quarter.refresh_from_db()
+        self.assertEqual(self.quarter.name_path, "accounting/2024/q3")
+
+        archive = Folder.objects.create(name="archive")
+        self.year.parent = archive
+        self.year.save()
+        self.assertEqual(self.resolve("archive/2024/q3").data["id"], self.quarter.pk)
+        self.assertEqual(
+            self.resolve("accounting/2024").status_code, status.HTTP_404_NOT_FOUND
+        )
+
+    def test_batch_resolution_uses_constant_queries(self):
+        paths = [
+            "finance",
+            "finance/2024",
+            "finance/2024/q3",
+            "finance/2024/q3/report.pdf",
+            "finance/missing.pdf",
+        ]
+        access_scope(self.user)  # the folder grants are cached separately
+
+        # folders, documents
+        with self.assertNumQueries(2):
+            response = self.client.post(
+                reverse("resolve"), {"paths": paths}, format="json"
+            )
+
+        results = response.data["results"]
+        self.assertEqual([result["path"] for result in results], paths)
+        self.assertEqual(results[3]["id"], self.report.pk)
+        self.assertEqual(results[4], {"path": paths[4], "type": None, "id": None})
+
+        with self.assertNumQueries(0):
+            self.client.post(reverse("resolve"), {"paths": paths}, format="json")
+
+    def test_cache_expires_on_changes(self):
+        self.assertEqual(self.resolve("finance/2024/q4").status_code, 404)
+
+        q4 = Folder.objects.create(name="q4", parent=self.year)
+        self.assertEqual(self.resolve("finance/2024/q4").data["id"], q4.pk)
+
+    def test_restricted_paths_are_not_resolved(self):
+        FolderPermission.objects.create(
+            folder=self.year, user=User.objects.create_user(username="other")
+        )
+
+        response = self.resolve("finance/2024/q3/report.pdf")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_imported_folders_can_be_resolved(self):
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, "w") as zipped:
+            zipped.writestr("q4/notes/", b"")
+        archive.seek(0)
+        with override_settings(MEDIA_ROOT=tempfile.mkdtemp()):
+            import_archive(archive, self.year)
+
+        response = self.resolve("finance/2024/q4/notes")
+        self.assertEqual(response.data["type"], "folder")
@@ -1,6 +1,7 @@
+from django.urls import path
 from rest_framework.routers import DefaultRouter
 
-from .views import TopicViewSet, FolderViewSet, DocumentViewSet
+from .views import TopicViewSet, FolderViewSet, DocumentViewSet, ResolveView
 
 router = DefaultRouter()
 
@@ -8,4 +9,6 @@ router.register(r"topics", TopicViewSet, basename="topic")
 router.register(r"documents", DocumentViewSet, basename="document")
 router.register(r"folders", FolderViewSet, basename="folder")
 
-urlpatterns = router.urls
+urlpatterns = router.urls + [
+    path("resolve/", ResolveView.as_view(), name="resolve"),
+]
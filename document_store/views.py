@@ -1,35 +1,184 @@
+import json
+import mimetypes
+from urllib.parse import urlencode
+
 from django.core.cache import cache
+from django.db.models import Count, F, Prefetch
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from rest_framework import viewsets, authentication, permissions
+from django.http import FileResponse, Http404, StreamingHttpResponse
+from django.utils.http import content_disposition_header
+from rest_framework import viewsets, authentication, permissions, status
+from rest_framework.decorators import action
+from rest_framework.exceptions import PermissionDenied, ValidationError
+from rest_framework.generics import get_object_or_404
 from rest_framework.response import Response
+from rest_framework.views import APIView
 
-from .cache_manager import CacheKeys
-from .models import Document, Folder, Topic
+from .access import (
+    access_scope,
+    can_write,
+    visible_folders,
+    visible_subtree_aggregates,
+)
+from .aggregates import parse_tree_path
+from .archive import stream_folder_archive
+from .cache_manager import CacheKeys, expire_shaped_cache, shaped_cache_key
+from .importer import ArchiveImportError, import_archive
+from .models import Chunk, Document, Folder, FolderPermission, Topic
 from .pagination import StandardPagination
-from .serializers import FolderSerializer, TopicSerializer, DocumentSerializer
-from .slack import notify_slack_on_upload
+from .paths import MAX_RESOLVE_PATHS, resolve_paths
+from .revisions import (
+    MAX_CHUNK_SIZE,
+    chunk_digest,
+    missing_chunks,
+    restore_revision,
+    save_from_chunks,
+    store_chunks,
+)
+from .serializers import (
+    DEFAULT_SHAPE,
+    DocumentRevisionSerializer,
+    DocumentSerializer,
+    FolderPermissionSerializer,
+    FolderSerializer,
+    Shape,
+    TopicSerializer,
+    load_folder_names,
+    split_param,
+)
+from .slack import notify_slack_on_import, notify_slack_on_upload
 
+# columns each ``?facets=`` name groups documents by, an id and a label
+DOCUMENT_FACETS = {
+    "topic": ("topic", "topic__name"),
+    "folder": ("folder", "folder__name"),
+    "content_type": ("content_type", None),
+}
+# folder fields that would count folders the user cannot see
+SUBTREE_AGGREGATES = ("subtree_document_count", "subtree_size", "subtree_last_modified")
 
-class TopicViewSet(viewsets.ModelViewSet):
-    queryset = Topic.objects.all()
-    serializer_class = TopicSerializer
-    pagination_class = StandardPagination
-    permission_classes = [permissions.IsAuthenticated]
-    authentication_classes = [authentication.TokenAuthentication]
+
+def require_write(user, *folders):
+    for folder in folders:
+        if folder is not None and not can_write(user, folder):
+            raise PermissionDenied(f"You cannot change the folder {folder.name}.")
+
+
+def count_facets(queryset, names):
+    """
+    Count ``queryset`` grouped by each facet, one query per facet. Ties are
+    broken by value with the missing value last, whatever the database.
+    """
+    facets = {}
+    for name in sorted(names):
+        value, label = DOCUMENT_FACETS[name]
+        columns = [value] if label is None else [value, label]
+        rows = (
+            queryset.order_by()
+            .values(*columns)
+            .annotate(count=Count("id"))
+            .order_by("-count", F(value).asc(nulls_last=True))
+        )
+        facets[name] = [
+            {"value": row[value], "label": row[label or value], "count": row["count"]}
+            for row in rows
+        ]
+    return facets
+
+
+def only_requested(queryset, shape, *required):
+    """Defer the model columns that were left out of ``?fields=``."""
+    if shape.fields is None:
+        return queryset
+    columns = {field.name for field in queryset.model._meta.concrete_fields}
+    return queryset.only("id", *(columns & shape.fields), *required)
+
+
+class CachedShapeMixin:
+    """
+    Serves ``?fields=`` / ``?expand=`` on list and retrieve, caching each
+    response under the key of its shape.
+    """
+
+    list_cache_key = None
+    detail_cache_key_prefix = None
+
+    @property
+    def shape(self):
+        if not hasattr(self, "_shape"):
+            self._shape = DEFAULT_SHAPE
+            if self.action in ("list", "retrieve"):
+                self._shape = Shape.from_request(self.request, self.serializer_class)
+        return self._shape
+
+    def get_folder_paths(self, instances):
+        """Tree paths whose folder names the page will render."""
+        return []
+
+    def get_aggregate_folders(self, instances):
+        """Folders whose subtree aggregates the page will render."""
+        return []
+
+    def get_cache_scope(self):
+        """Names the users that may share cached responses."""
+        return ""
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context["folder_names"] = {}
+        context["visible_aggregates"] = {}
+        return context
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault("shape", self.shape)
+        serializer = super().get_serializer(*args, **kwargs)
+        if args:
+            instances = args[0] if kwargs.get("many") else [args[0]]
+            folder_ids = {
+                pk
+                for tree_path in self.get_folder_paths(instances)
+                for pk in parse_tree_path(tree_path)
+            }
+            load_folder_names(serializer.context["folder_names"], folder_ids)
+            serializer.context["visible_aggregates"].update(
+                visible_subtree_aggregates(
+                    self.request.user, self.get_aggregate_folders(instances)
+                )
+            )
+        return serializer
+
+    def get_cache_query(self):
+        """The query parameters besides the shape, e.g. filters and page."""
+        params = sorted(
+            (name, value)
+            for name, value in self.request.query_params.items()
+            if name not in ("fields", "expand")
+        )
+        return urlencode(params)
 
     def list(self, request, *args, **kwargs):
-        cached_data = cache.get(CacheKeys.TOPIC_LIST_KEY)
+        cache_key = shaped_cache_key(
+            self.list_cache_key,
+            self.shape,
+            self.get_cache_scope(),
+            self.get_cache_query(),
+        )
+        cached_data = cache.get(cache_key)
 
-        if cached_data:
+        if cached_data is not None:
             return Response(cached_data)
 
         response = super().list(request, *args, **kwargs)
-        cache.set(CacheKeys.TOPIC_LIST_KEY, response.data)
+        cache.set(cache_key, response.data)
         return response
 
     def retrieve(self, request, *args, **kwargs):
-        cache_key = f"{CacheKeys.TOPIC_DETAIL_KEY_PREFIX}{kwargs['pk']}"
+        cache_key = shaped_cache_key(
+            f"{self.detail_cache_key_prefix}{kwargs['pk']}",
+            self.shape,
+            self.get_cache_scope(),
+        )
         cached_data = cache.get(cache_key)
 
         if cached_data is not None:
@@ -40,75 +189,369 @@ class TopicViewSet(viewsets.ModelViewSet):
         return response
 
 
-class FolderViewSet(viewsets.ModelViewSet):
-    queryset = Folder.objects.all()
+class TopicViewSet(CachedShapeMixin, viewsets.ModelViewSet):
+    serializer_class = TopicSerializer
+    pagination_class = StandardPagination
+    permission_classes = [permissions.IsAuthenticated]
+    authentication_classes = [authentication.TokenAuthentication]
+    list_cache_key = CacheKeys.TOPIC_LIST_KEY
+    detail_cache_key_prefix = CacheKeys.TOPIC_DETAIL_KEY_PREFIX
+
+    def get_queryset(self):
+        return only_requested(Topic.objects.all(), self.shape)
+
+
+class FolderViewSet(CachedShapeMixin, viewsets.ModelViewSet):
     serializer_class = FolderSerializer
     pagination_class = StandardPagination
     permission_classes = [permissions.IsAuthenticated]
     authentication_classes = [authentication.TokenAuthentication]
+    list_cache_key = CacheKeys.FOLDER_LIST_KEY
+    detail_cache_key_prefix = CacheKeys.FOLDER_DETAIL_KEY_PREFIX
 
-    def list(self, request, *args, **kwargs):
-        cached_data = cache.get(CacheKeys.FOLDER_LIST_KEY)
+    def get_folder_paths(self, instances):
+        if self.shape.expands("path") or "path" in self.shape.nested("parent"):
+            return [folder.tree_path for folder in instances]
+        return []
 
-        if cached_data is not None:
-            return Response(cached_data)
+    def get_aggregate_folders(self, instances):
+        folders = []
+        if any(self.shape.includes(name) for name in SUBTREE_AGGREGATES):
+            folders += instances
+        if self.shape.expands("parent"):
+            folders += [folder.parent for folder in instances if folder.parent_id]
+        return folders
 
-        response = super().list(request, *args, **kwargs)
-        cache.set(CacheKeys.FOLDER_LIST_KEY, response.data)
-        return response
+    def get_cache_scope(self):
+        return access_scope(self.request.user)
 
-    def retrieve(self, request, *args, **kwargs):
-        cache_key = f"{CacheKeys.FOLDER_DETAIL_KEY_PREFIX}{kwargs['pk']}"
-        cached_data = cache.get(cache_key)
+    def get_queryset(self):
+        shape = self.shape
+        visible = visible_folders(self.request.user)
+        queryset = Folder.objects.filter(visible)
+        required = []
 
-        if cached_data is not None:
-            return Response(cached_data)
+        if shape.expands("parent"):
+            queryset = queryset.select_related("parent")
+            required.append("parent")
+        if shape.expands("path") or "path" in shape.nested("parent"):
+            required.append("tree_path")
+        if any(shape.includes(name) for name in SUBTREE_AGGREGATES):
+            required.append("tree_path")
+        if shape.includes("children"):
+            queryset = queryset.prefetch_related(
+                Prefetch(
+                    "child_folders",
+                    Folder.objects.filter(visible).only("name", "parent"),
+                ),
+                Prefetch("documents", Document.objects.only("name", "folder")),
+            )
 
-        response = super().retrieve(request, *args, **kwargs)
-        cache.set(cache_key, response.data)
+        return only_requested(queryset, shape, *required)
+
+    def perform_create(self, serializer):
+        require_write(self.request.user, serializer.validated_data.get("parent"))
+        serializer.save()
+
+    def perform_update(self, serializer):
+        require_write(
+            self.request.user,
+            serializer.instance,
+            serializer.validated_data.get("parent"),
+        )
+        serializer.save()
+
+    def perform_destroy(self, instance):
+        require_write(self.request.user, instance)
+        instance.delete()
+
+    @action(detail=True, methods=["get"])
+    def archive(self, request, pk=None):
+        folder = self.get_object()
+        response = StreamingHttpResponse(
+            stream_folder_archive(folder, visible_folders(request.user)),
+            content_type="application/zip",
+        )
+        response["Content-Disposition"] = content_disposition_header(
+            True, f"{folder.name}.zip"
+        )
         return response
 
+    @action(detail=True, methods=["post"], url_path="import")
+    def import_archive(self, request, pk=None):
+        folder = self.get_object()
+        require_write(request.user, folder)
+        archive_file = request.FILES.get("archive")
+        if archive_file is None:
+            raise ValidationError({"archive": "No archive was uploaded."})
 
-class DocumentViewSet(viewsets.ModelViewSet):
+        topic = None
+        if request.data.get("topic"):
+            topic = get_object_or_404(Topic, pk=request.data["topic"])
+
+        try:
+            report = import_archive(
+                archive_file, folder, topic=topic, user=request.user
+            )
+        except ArchiveImportError as exc:
+            raise ValidationError({"archive": str(exc)})
+
+        notify_slack_on_import(folder, report)
+        return Response(report.as_dict(), status=status.HTTP_201_CREATED)
+
+    @action(
+        detail=True,
+        methods=["get", "post"],
+        url_path="permissions",
+        permission_classes=[permissions.IsAdminUser],
+    )
+    def acl(self, request, pk=None):
+        folder = get_object_or_404(Folder, pk=pk)
+        if request.method == "POST":
+            serializer = FolderPermissionSerializer(data=request.data)
+            serializer.is_valid(raise_exception=True)
+            serializer.save(folder=folder)
+            return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+        serializer = FolderPermissionSerializer(folder.permissions.all(), many=True)
+        return Response(serializer.data)
+
+    @action(
+        detail=True,
+        methods=["delete"],
+        url_path=r"permissions/(?P<permission_id>\d+)",
+        permission_classes=[permissions.IsAdminUser],
+    )
+    def remove_acl(self, request, pk=None, permission_id=None):
+        entry = get_object_or_404(FolderPermission, pk=permission_id, folder_id=pk)
+        entry.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class DocumentViewSet(CachedShapeMixin, viewsets.ModelViewSet):
     serializer_class = DocumentSerializer
     pagination_class = StandardPagination
     permission_classes = [permissions.IsAuthenticated]
     authentication_classes = [authentication.TokenAuthentication]
+    list_cache_key = CacheKeys.DOCUMENT_LIST_KEY
+    detail_cache_key_prefix = CacheKeys.DOCUMENT_DETAIL_KEY_PREFIX
 
-    def list(self, request, *args, **kwargs):
-        cached_data = cache.get(CacheKeys.DOCUMENT_LIST_KEY)
-
-        if cached_data is not None:
-            return Response(cached_data)
-
-        response = super().list(request, *args, **kwargs)
-        cache.set(CacheKeys.DOCUMENT_LIST_KEY, response.data)
-        return response
+    def get_folder_paths(self, instances):
+        if "path" in self.shape.nested("folder"):
+            return [document.folder.tree_path for document in instances]
+        return []
 
-    def retrieve(self, request, *args, **kwargs):
-        cache_key = f"{CacheKeys.DOCUMENT_DETAIL_KEY_PREFIX}{kwargs['pk']}"
-        cached_data = cache.get(cache_key)
+    def get_aggregate_folders(self, instances):
+        if self.shape.expands("folder"):
+            return [document.folder for document in instances]
+        return []
 
-        if cached_data is not None:
-            return Response(cached_data)
+    def get_cache_scope(self):
+        return access_scope(self.request.user)
 
-        response = super().retrieve(request, *args, **kwargs)
-        cache.set(cache_key, response.data)
-        return response
+    @property
+    def facets(self):
+        if not hasattr(self, "_facets"):
+            facets = split_param(self.request.query_params.get("facets", ""))
+            unknown = sorted(facets - DOCUMENT_FACETS.keys())
+            if unknown:
+                raise ValidationError(
+                    {"facets": f"Cannot count facets {', '.join(unknown)}."}
+                )
+            self._facets = facets
+        return self._facets
 
     def get_queryset(self):
-        queryset = Document.objects.select_related("topic", "folder").all()
+        shape = self.shape
+        queryset = Document.objects.filter(
+            visible_folders(self.request.user, "folder__")
+        )
         topic = self.request.query_params.get("topic")
 
         if topic is not None:
             queryset = queryset.filter(topic__name=topic)
 
-        return queryset
+        related = [name for name in ("folder", "topic") if shape.expands(name)]
+        if related:
+            queryset = queryset.select_related(*related)
+
+        return only_requested(queryset, shape, *related)
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if self.action == "list" and self.facets:
+            queryset = self.filter_queryset(self.get_queryset())
+            response.data["facets"] = count_facets(queryset, self.facets)
+        return response
 
     def perform_create(self, serializer):
+        require_write(self.request.user, serializer.validated_data.get("folder"))
         document = serializer.save()
         notify_slack_on_upload(document)
 
+    def perform_update(self, serializer):
+        require_write(
+            self.request.user,
+            serializer.instance.folder,
+            serializer.validated_data.get("folder"),
+        )
+        serializer.save()
+
+    def perform_destroy(self, instance):
+        require_write(self.request.user, instance.folder)
+        instance.delete()
+
+    @action(detail=True, methods=["get"])
+    def download(self, request, pk=None):
+        document = self.get_object()
+        if not document.file:
+            raise Http404
+
+        storage = document.file.storage
+        accept_encoding = request.headers.get("Accept-Encoding", "")
+        if hasattr(storage, "open_encoded"):
+            stored, encoding, length = storage.open_encoded(
+                document.file.name, accept_encoding
+            )
+        else:
+            stored, encoding, length = storage.open(document.file.name), None, None
+
+        response = FileResponse(
+            stored,
+            as_attachment=True,
+            filename=document.name,
+            content_type=document.content_type or "application/octet-stream",
+        )
+        if length is not None:
+            response["Content-Length"] = length
+        if encoding is not None:
+            response["Content-Encoding"] = encoding
+        response["Vary"] = "Accept-Encoding"
+        return response
+
+    @action(detail=True, methods=["get", "post"])
+    def revisions(self, request, pk=None):
+        document = self.get_object()
+        if request.method == "POST":
+            require_write(request.user, document.folder)
+            return self.upload_revision(request, document)
+
+        page = self.paginate_queryset(document.revisions.all())
+        serializer = DocumentRevisionSerializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    def upload_revision(self, request, document):
+        """
+        Store a new version either as a whole ``file`` or as a ``manifest``
+        of chunk digests. Chunks the server doesn't have yet are sent as
+        files named by their digest; when any are missing the response
+        lists them so that the client can send only those.
+        """
+        if "file" in request.FILES:
+            serializer = DocumentSerializer(
+                document, data={"file": request.FILES["file"]}, partial=True
+            )
+            serializer.is_valid(raise_exception=True)
+            serializer.save()
+        else:
+            manifest = request.data.get("manifest")
+            if isinstance(manifest, str):
+                try:
+                    manifest = json.loads(manifest)
+                except ValueError:
+                    manifest = None
+            if not isinstance(manifest, list) or not all(
+                isinstance(digest, str) for digest in manifest
+            ):
+                raise ValidationError({"manifest": "Expected a list of digests."})
+
+            uploaded = {}
+            for digest, chunk in request.FILES.items():
+                if chunk.size > MAX_CHUNK_SIZE:
+                    raise ValidationError(
+                        {digest: f"Chunks are at most {MAX_CHUNK_SIZE} bytes."}
+                    )
+                data = chunk.read()
+                if chunk_digest(data) != digest:
+                    raise ValidationError({digest: "Digest does not match content."})
+                uploaded[digest] = data
+            store_chunks(document.file.storage, uploaded.values())
+
+            missing = missing_chunks(manifest)
+            if missing:
+                return Response(
+                    {"missing": missing}, status=status.HTTP_400_BAD_REQUEST
+                )
+
+            sizes = dict(
+                Chunk.objects.filter(pk__in=set(manifest)).values_list("digest", "size")
+            )
+            file_name = request.data.get("file_name") or document.name
+            document.content_type = (
+                request.data.get("content_type")
+                or mimetypes.guess_type(file_name)[0]
+                or ""
+            )
+            save_from_chunks(
+                document,
+                file_name,
+                manifest,
+                sum(sizes[digest] for digest in manifest),
+            )
+
+        serializer = DocumentRevisionSerializer(document.revisions.first())
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    @action(
+        detail=True,
+        methods=["post"],
+        url_path=r"revisions/(?P<number>\d+)/restore",
+    )
+    def restore(self, request, pk=None, number=None):
+        document = self.get_object()
+        require_write(request.user, document.folder)
+        revision = get_object_or_404(document.revisions, number=number)
+        serializer = DocumentRevisionSerializer(restore_revision(revision))
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+class ResolveView(APIView):
+    """
+    Look up folders and documents by their ``a/b/c`` path: GET one
+    ``?path=``, or POST a list of ``paths`` to resolve them all at once.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+    authentication_classes = [authentication.TokenAuthentication]
+
+    def get(self, request):
+        path = request.query_params.get("path")
+        if not path:
+            raise ValidationError({"path": "This parameter is required."})
+
+        resolved = resolve_paths(request.user, [path])[path]
+        if resolved is None:
+            raise Http404
+        return Response({"path": path, **resolved})
+
+    def post(self, request):
+        paths = request.data.get("paths")
+        if not isinstance(paths, list) or not all(
+            isinstance(path, str) for path in paths
+        ):
+            raise ValidationError({"paths": "Expected a list of paths."})
+        if len(paths) > MAX_RESOLVE_PATHS:
+            raise ValidationError(
+                {"paths": f"Resolve at most {MAX_RESOLVE_PATHS} paths at once."}
+            )
+
+        resolved = resolve_paths(request.user, paths)
+        results = [
+            {"path": path, **(resolved[path] or {"type": None, "id": None})}
+            for path in paths
+        ]
+        return Response({"results": results})
+
 
 @receiver([post_save, post_delete], sender=Topic)
 @receiver([post_save, post_delete], sender=Folder)
@@ -120,3 +563,4 @@ def invalidate_cache(sender, instance, **kwargs):
     cache.delete(CacheKeys.FOLDER_DETAIL_KEY_PREFIX + str(instance.pk))
     cache.delete(CacheKeys.DOCUMENT_LIST_KEY)
     cache.delete(CacheKeys.DOCUMENT_DETAIL_KEY_PREFIX + str(instance.pk))
+    expire_shaped_cache()